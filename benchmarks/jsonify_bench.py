@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+"""
+    Micro-benchmark of the serialization of the alerts sent to TheHive:
+    the indented, sorted jsonify() against jsonify(compact=True)
+
+    python3 benchmarks/jsonify_bench.py --artifacts 500 --description-bytes 65536
+"""
+
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from objects.thehive4py import models
+from objects.thehive4py.models import Alert, AlertArtifact
+
+def buildAlert(artifacts, descriptionBytes):
+    return Alert(title='Offense 1234',
+        tlp=2,
+        severity=2,
+        tags=['QRadar', 'Offense', 'Synapse'],
+        type='Local_Dest_IP',
+        source='QRadar_Offenses',
+        sourceRef='1234',
+        description='x' * descriptionBytes,
+        artifacts=[AlertArtifact(dataType='ip', data='10.0.%d.%d' % (i // 256, i % 256),
+            message='Source IP', tags=['src']) for i in range(artifacts)])
+
+def bench(name, func, number, repeat):
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    print('%-30s %10.1f us  %8d bytes' % (name, best * 1e6, len(func())))
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the alert serialization')
+    parser.add_argument('--artifacts', type=int, default=500)
+    parser.add_argument('--description-bytes', type=int, default=65536)
+    parser.add_argument('--number', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    alert = buildAlert(args.artifacts, args.description_bytes)
+    print('%d artifacts, %d bytes of description, orjson %s' % (args.artifacts,
+        args.description_bytes, 'installed' if models.orjson is not None else 'not installed'))
+
+    pretty = bench('jsonify()', alert.jsonify, args.number, args.repeat)
+    compact = bench('jsonify(compact=True)', lambda: alert.jsonify(compact=True),
+        args.number, args.repeat)
+
+    orjson = models.orjson
+    models.orjson = None
+    try:
+        compactJson = bench('jsonify(compact=True), json', lambda: alert.jsonify(compact=True),
+            args.number, args.repeat)
+    finally:
+        models.orjson = orjson
+
+    print('speedup: %.1fx, %.1fx with json' % (pretty / compact, pretty / compactJson))
@@ -1,4 +1,4 @@
 from .qradar_connector import QRadarConnector
 from .thehive_connector import TheHiveConnector
 from .offense2alert import allOffense2Alert
-from .common import getConf, setConf
\ No newline at end of file
+from .common import getConf
\ No newline at end of file
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+def alertContentHash(alert):
+    """
+        Returns a hash of the alert content, alert being either
+        a dict as returned by TheHive or an Alert object
+    """
+    fields = ('title', 'description', 'severity', 'tags')
+    if isinstance(alert, dict):
+        content = dict((k, alert.get(k)) for k in fields)
+    else:
+        content = dict((k, getattr(alert, k, None)) for k in fields)
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+class AlertIndex:
+    'Local SQLite index of the offenses already imported as alerts in TheHive'
+
+    def __init__(self, path):
+        """
+            Class constructor
+
+            :param path: path of the SQLite database, created if needed
+            :type path: str
+
+            :return: Object AlertIndex
+            :rtype: AlertIndex
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        #the connection is shared by the workers, access is serialized
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS alerts ('
+            'source_ref TEXT PRIMARY KEY, '
+            'alert_id TEXT NOT NULL, '
+            'created_at INTEGER, '
+            'content_hash TEXT)')
+        #alerts created without their logs (two-phase publishing)
+        self.db.execute('CREATE TABLE IF NOT EXISTS pending_logs ('
+            'alert_id TEXT PRIMARY KEY, '
+            'offense TEXT NOT NULL, '
+            'attempt INTEGER NOT NULL, '
+            'due_at REAL NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta ('
+            'key TEXT PRIMARY KEY, '
+            'value TEXT)')
+
+    def get(self, sourceRef):
+        """
+            Returns the index entry for sourceRef as a dict
+            (source_ref, alert_id, created_at, content_hash), None if
+            the offense is not indexed
+        """
+        with self.lock:
+            row = self.db.execute('SELECT source_ref, alert_id, created_at, content_hash '
+                'FROM alerts WHERE source_ref = ?', (sourceRef,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('source_ref', 'alert_id', 'created_at', 'content_hash'), row))
+
+    def add(self, sourceRef, alertId, createdAt=None, contentHash=None):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?)',
+                (sourceRef, alertId, createdAt, contentHash))
+
+    def isReconciled(self):
+        """
+            True if the index has been rebuilt from TheHive at least once,
+            in which case an offense missing from the index has not been
+            imported yet
+        """
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'reconciled_at'").fetchone()
+        return row is not None
+
+    def unreconcile(self):
+        """
+            Marks the index as not reconciled, an offense missing from it
+            being searched in TheHive again until the next rebuild
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM meta WHERE key = 'reconciled_at'")
+
+    def rebuild(self, pages):
+        """
+            Replaces the index content with the alerts found in TheHive;
+            the pages are stored in a temporary table, swapped into the
+            index by a short transaction, so that a running instance keeps
+            indexing the alerts it creates meanwhile
+
+            :param pages: iterable of lists of alerts as returned by TheHive
+            :type pages: iterable
+
+            :return count: number of indexed alerts
+            :rtype count: int
+        """
+
+        self.logger.info('%s.rebuild starts', __name__)
+
+        startedAt = int(time.time() * 1000)
+        count = 0
+        with self.lock:
+            self.db.execute('DROP TABLE IF EXISTS temp.alerts_rebuild')
+            self.db.execute('CREATE TEMP TABLE alerts_rebuild ('
+                'source_ref TEXT PRIMARY KEY, '
+                'alert_id TEXT NOT NULL, '
+                'created_at INTEGER, '
+                'content_hash TEXT)')
+        try:
+            for page in pages:
+                with self.lock:
+                    self.db.executemany('INSERT OR REPLACE INTO alerts_rebuild VALUES (?, ?, ?, ?)',
+                        [(alert['sourceRef'], alert['id'], alert.get('createdAt'),
+                            alertContentHash(alert)) for alert in page])
+                count += len(page)
+                self.logger.info('%s alerts indexed', count)
+
+            with self.lock:
+                self.db.execute('BEGIN IMMEDIATE')
+                try:
+                    #the alerts created since the rebuild started are kept
+                    self.db.execute('DELETE FROM alerts WHERE created_at < ? AND '
+                        'source_ref NOT IN (SELECT source_ref FROM alerts_rebuild)',
+                        (startedAt,))
+                    self.db.execute('INSERT OR REPLACE INTO alerts SELECT * FROM alerts_rebuild')
+                    self.db.execute("INSERT OR REPLACE INTO meta VALUES ('reconciled_at', ?)",
+                        (str(int(time.time() * 1000)),))
+                    self.db.execute('COMMIT')
+                except Exception:
+                    self.db.execute('ROLLBACK')
+                    raise
+        finally:
+            with self.lock:
+                self.db.execute('DROP TABLE IF EXISTS temp.alerts_rebuild')
+
+        return count
+
+    def setPendingLogs(self, alertId, offense, attempt, dueAt):
+        """
+            Records that the logs of offense are still to be added to the
+            description of alert alertId, from dueAt (seconds since epoch)
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO pending_logs VALUES (?, ?, ?, ?)',
+                (alertId, json.dumps(offense), attempt, dueAt))
+
+    def removePendingLogs(self, alertId):
+        with self.lock:
+            self.db.execute('DELETE FROM pending_logs WHERE alert_id = ?', (alertId,))
+
+    def getPendingLogs(self):
+        """
+            Returns the pending log attachments as
+            (alert_id, offense, attempt, due_at) tuples, the first due first
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT alert_id, offense, attempt, due_at '
+                'FROM pending_logs ORDER BY due_at').fetchall()
+        return [(alertId, json.loads(offense), attempt, dueAt)
+            for alertId, offense, attempt, dueAt in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
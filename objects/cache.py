@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .common import loadSnapshot, saveSnapshot
+
+class LRUCache:
+    'Thread safe LRU cache whose entries expire after ttl seconds'
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+            Class constructor
+
+            :param maxsize: maximum number of entries, the least recently
+                            used entry is evicted beyond
+            :type maxsize: int
+            :param ttl: entries lifetime in seconds, None for no expiry
+            :type ttl: float
+
+            :return: Object LRUCache
+            :rtype: LRUCache
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        #key -> (expiry as epoch or None, value), most recently used last
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.time()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        expiry = None
+        if self.ttl is not None:
+            expiry = time.time() + self.ttl
+        with self.lock:
+            self.entries[key] = (expiry, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+    def load(self, path):
+        """
+            Loads the entries saved in path by save(), expired entries
+            are dropped; keys are expected to be strings
+        """
+        snapshot = loadSnapshot(path)
+        if snapshot is None:
+            return
+        now = time.time()
+        with self.lock:
+            for key, expiry, value in snapshot['entries']:
+                if expiry is None or expiry > now:
+                    self.entries[key] = (expiry, value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        self.logger.info('%s entries loaded from %s', len(self.entries), path)
+
+    def save(self, path):
+        with self.lock:
+            entries = [[key, expiry, value] for key, (expiry, value) in self.entries.items()]
+        saveSnapshot(path, {'entries': entries})
+
+class Catalogue:
+    'QRadar catalogue (offense types, rules...) loaded at once and refreshed every ttl seconds'
+
+    def __init__(self, name, loader, ttl, snapshotPath='', refreshInterval=60):
+        """
+            Class constructor
+
+            :param name: catalogue name, for logging
+            :type name: str
+            :param loader: callable returning the whole catalogue as
+                           {object id (int): value}
+            :type loader: callable
+            :param ttl: seconds before the catalogue is reloaded
+            :type ttl: float
+            :param snapshotPath: file the catalogue is saved to for
+                                 warm startups, empty to disable
+            :type snapshotPath: str
+            :param refreshInterval: minimum seconds between two reloads
+                                    triggered by unknown ids
+            :type refreshInterval: float
+
+            :return: Object Catalogue
+            :rtype: Catalogue
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.snapshotPath = snapshotPath
+        self.refreshInterval = refreshInterval
+        self.items = {}
+        #last successful load
+        self.loadedAt = 0
+        #last load attempt, successful or not, reloads are rate-limited on it
+        self.lastAttemptAt = 0
+        self.lock = threading.RLock()
+
+    def get(self):
+        """
+            Returns the catalogue, loaded from the snapshot or with
+            the loader when missing or older than ttl
+        """
+
+        with self.lock:
+            now = time.time()
+            if self.loadedAt and now - self.loadedAt < self.ttl:
+                return self.items
+            if now - self.lastAttemptAt < self.refreshInterval:
+                #the last attempt failed, keeping the previous catalogue (if any)
+                return self.items
+
+            if not self.items:
+                #warm startup from the on-disk snapshot
+                snapshot = loadSnapshot(self.snapshotPath)
+                if snapshot is not None and now - snapshot['loaded_at'] < self.ttl:
+                    self.logger.info('%s catalogue loaded from %s', self.name, self.snapshotPath)
+                    self.items = dict((int(k), v) for k, v in snapshot['items'].items())
+                    self.loadedAt = snapshot['loaded_at']
+                    return self.items
+
+            return self.reload()
+
+    def reload(self):
+        with self.lock:
+            now = time.time()
+            self.lastAttemptAt = now
+            try:
+                self.items = self.loader()
+                self.loadedAt = now
+                saveSnapshot(self.snapshotPath, {'loaded_at': now, 'items': self.items})
+            except Exception as e:
+                #keeping the previous catalogue (if any) and retrying
+                #in refreshInterval seconds
+                self.logger.warning('Failed to load the %s catalogue', self.name, exc_info=True)
+
+            return self.items
+
+    def lookup(self, itemId):
+        """
+            Returns the catalogue value for itemId, reloading the catalogue
+            if the id is unknown (at most once every refreshInterval seconds),
+            None if the id is still unknown
+        """
+
+        with self.lock:
+            items = self.get()
+            if itemId not in items and time.time() - self.lastAttemptAt >= self.refreshInterval:
+                self.logger.info('Unknown %s id %s, reloading the catalogue', self.name, itemId)
+                items = self.reload()
+            return items.get(itemId)
+
+    def add(self, itemId, value):
+        with self.lock:
+            self.items[itemId] = value
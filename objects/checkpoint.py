@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+
+from .common import atomicWrite, resolvePath
+
+class CheckpointStore:
+    'Durable record of the last imported offense id, kept apart from the configuration'
+
+    def __init__(self, path):
+        """
+            Class constructor
+
+            :param path: path of the checkpoint file, created on the
+                         first update
+            :type path: str
+
+            :return: Object CheckpointStore
+            :rtype: CheckpointStore
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.offenseIdAfter = None
+        #offenses deferred to the next run, {offense id: (attempt, due_at)}
+        self.deferred = dict()
+
+        if os.path.exists(path):
+            with open(path, 'r') as checkpointFile:
+                checkpoint = json.load(checkpointFile)
+            self.offenseIdAfter = checkpoint['offense_id_after']
+            for offenseId, (attempt, dueAt) in checkpoint.get('deferred', {}).items():
+                self.deferred[int(offenseId)] = (attempt, dueAt)
+
+    def get(self, default=None):
+        """
+            Returns the last imported offense id, default if no
+            checkpoint has been recorded yet
+        """
+        with self.lock:
+            if self.offenseIdAfter is None:
+                return default
+            return self.offenseIdAfter
+
+    def getDeferred(self):
+        """
+            Returns the offenses deferred by the previous run,
+            {offense id: (attempt, due_at)} due_at being an epoch in seconds
+        """
+        with self.lock:
+            return dict(self.deferred)
+
+    def advance(self, offenseId):
+        """
+            Records offenseId as the last imported offense id, unless an
+            offense after it has already been recorded; the checkpoint file
+            is replaced atomically and synced to disk
+
+            :param offenseId: offense id
+            :type offenseId: int
+        """
+        with self.lock:
+            if self.offenseIdAfter is not None and offenseId <= self.offenseIdAfter:
+                return
+            self.offenseIdAfter = offenseId
+            self.write()
+            self.logger.debug('checkpoint advanced to offense %s', offenseId)
+
+    def defer(self, deferred):
+        """
+            Records the offenses left to the next run, the checkpoint
+            being held below them
+
+            :param deferred: {offense id: (attempt, due_at)}
+            :type deferred: dict
+        """
+        with self.lock:
+            if deferred == self.deferred:
+                return
+            self.deferred = dict(deferred)
+            self.write()
+
+    def write(self):
+        atomicWrite(self.path, json.dumps({
+            'offense_id_after': self.offenseIdAfter,
+            'deferred': dict((str(offenseId), list(state))
+                for offenseId, state in self.deferred.items()),
+            'updated_at': int(time.time() * 1000)
+        }), durable=True)
+
+def loadCheckpoint(cfg):
+    """
+        Returns the checkpoint store and the id of the last imported
+        offense; offense_id_after in the [QRadar] section only seeds it
+        until the first checkpoint is written (-1 if not set)
+
+        :rtype: tuple
+    """
+    checkpoint = CheckpointStore(resolvePath(
+        cfg.get('smartclonner', 'checkpoint_file', fallback='cache/checkpoint.json')))
+    offenseLastId = checkpoint.get()
+    if offenseLastId is None:
+        seed = cfg.get('QRadar', 'offense_id_after', fallback='')
+        try:
+            offenseLastId = int(seed) if seed else -1
+        except ValueError:
+            raise ValueError('offense_id_after in [QRadar] should be an offense id, got %s' % seed)
+    return checkpoint, offenseLastId
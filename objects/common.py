@@ -3,52 +3,199 @@
 
 import logging
 import os
-import re
+import json
+import tempfile
+import threading
+import time
 from configparser import ConfigParser
 
 logger = logging.getLogger('workflows')
 
+# options without which smartclonner cannot run
+REQUIRED_OPTIONS = {
+    'TheHive': ('url', 'api_key'),
+    'QRadar': ('server', 'auth_token', 'api_version')
+}
+
+# options which must be parsable as int, float or boolean when set
+TYPED_OPTIONS = {
+    'int': (
+        ('smartclonner', 'workers'), ('smartclonner', 'max_inflight_offenses'),
+        ('TheHive', 'pool_size'), ('TheHive', 'retries'), ('TheHive', 'alert_index_page_size'),
+        ('QRadar', 'offense_page_size'), ('QRadar', 'address_batch_size'),
+        ('QRadar', 'address_cache_size'), ('QRadar', 'pool_size'),
+        ('QRadar', 'aql_batch_size'), ('QRadar', 'aql_max_concurrent_searches'),
+        ('QRadar', 'logs_count'), ('QRadar', 'log_max_bytes'), ('QRadar', 'logs_max_bytes'),
+        ('QRadar', 'logs_retries'), ('Metrics', 'http_port'),
+        ('Profiling', 'keep')),
+    'float': (
+        ('smartclonner', 'poll_interval'), ('smartclonner', 'poll_jitter'),
+        ('smartclonner', 'conf_reload_interval'), ('smartclonner', 'lock_heartbeat_interval'),
+        ('smartclonner', 'lock_stale_after'),
+        ('TheHive', 'connect_timeout'), ('TheHive', 'read_timeout'),
+        ('QRadar', 'address_lookup_timeout'), ('QRadar', 'address_cache_ttl'),
+        ('QRadar', 'offense_types_ttl'), ('QRadar', 'rules_ttl'),
+        ('QRadar', 'rules_refresh_interval'), ('QRadar', 'connect_timeout'),
+        ('QRadar', 'read_timeout'), ('QRadar', 'aql_search_timeout'),
+        ('QRadar', 'aql_batch_window'), ('QRadar', 'aql_poll_min_delay'),
+        ('QRadar', 'aql_poll_max_delay'), ('QRadar', 'logs_ready_delay'),
+        ('QRadar', 'logs_retry_delay'), ('QRadar', 'logs_retry_window'),
+        ('Profiling', 'sample_interval')),
+    'boolean': (
+        ('smartclonner', 'two_phase_publish'), ('QRadar', 'rule_names_tags'))
+}
+
+class Settings:
+    'Process-wide configuration, parsed once and reloaded when the file changes'
+
+    def __init__(self, confPath):
+        """
+            Class constructor
+
+            :param confPath: path of the configuration file
+            :type confPath: str
+
+            :return: Object Settings
+            :rtype: Settings
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.confPath = confPath
+        self.cfg = None
+        self.mtime = None
+        self.checkedAt = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+            Returns the configuration, the file being parsed on the first
+            call then only when its mtime has changed (checked at most every
+            conf_reload_interval seconds)
+
+            :rtype: ConfigParser
+        """
+
+        with self.lock:
+            if self.cfg is None:
+                self.load()
+                return self.cfg
+
+            now = time.monotonic()
+            reloadInterval = self.cfg.getfloat('smartclonner', 'conf_reload_interval', fallback=5)
+            if now - self.checkedAt < reloadInterval:
+                return self.cfg
+            self.checkedAt = now
+
+            try:
+                if os.stat(self.confPath).st_mtime_ns != self.mtime:
+                    self.logger.info('%s changed, reloading', self.confPath)
+                    self.load()
+            except Exception as e:
+                #keeping the current configuration
+                self.logger.error('Failed to reload %s: %s', self.confPath, str(e))
+
+            return self.cfg
+
+    def load(self):
+        mtime = os.stat(self.confPath).st_mtime_ns
+        cfg = ConfigParser(comment_prefixes='#', allow_no_value=True)
+        cfg.read(self.confPath)
+        self.validate(cfg)
+        self.cfg = cfg
+        self.mtime = mtime
+        self.checkedAt = time.monotonic()
+
+    def validate(self, cfg):
+        """
+            Raises ValueError if a required option is missing
+            or if an option cannot be parsed to its type
+        """
+        errors = []
+        for section, options in REQUIRED_OPTIONS.items():
+            for option in options:
+                if not cfg.has_option(section, option):
+                    errors.append('missing option %s in section [%s]' % (option, section))
+
+        getters = {'int': cfg.getint, 'float': cfg.getfloat, 'boolean': cfg.getboolean}
+        for optionType, options in TYPED_OPTIONS.items():
+            for section, option in options:
+                if cfg.has_option(section, option):
+                    try:
+                        getters[optionType](section, option)
+                    except ValueError:
+                        errors.append('option %s in section [%s] should be of type %s, got %s' %
+                            (option, section, optionType, cfg.get(section, option)))
+
+        if errors:
+            raise ValueError('Invalid configuration %s: %s' % (self.confPath, '; '.join(errors)))
+
+settings = Settings(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'conf', 'smartclonner.conf'))
+
 def getConf():
-    logger = logging.getLogger(__name__)
-    logger.info('%s.getConf starts', __name__)
+    return settings.get()
+
+def resolvePath(path):
+    """
+        Returns path as absolute, relative paths being relative
+        to the smartclonner directory; empty paths are returned as is
+    """
+    if not path or os.path.isabs(path):
+        return path
     currentPath = os.path.dirname(os.path.abspath(__file__))
-    cfg = ConfigParser(comment_prefixes='#', allow_no_value=True)
-    confPath = currentPath + '/../conf/smartclonner.conf'
-    print(confPath)
+    return os.path.normpath(os.path.join(currentPath, '..', path))
+
+def loadSnapshot(path):
+    """
+        Returns the json document saved in path with saveSnapshot,
+        None if there is no (readable) snapshot
+    """
+    logger = logging.getLogger(__name__)
+    if not path or not os.path.exists(path):
+        return None
     try:
-        cfg.read(confPath)
+        with open(path, 'r') as snapshotFile:
+            return json.load(snapshotFile)
     except Exception as e:
-        print(e)
-    return cfg
+        logger.warning('Failed to load snapshot %s: %s', path, str(e))
+        return None
 
-def setConf(cfg):
+def atomicWrite(path, content, durable=False):
+    """
+        Writes content (str) to path atomically: the content is written
+        in a temporary file which then replaces path, so that readers see
+        either the previous or the new content. With durable, the file and
+        its directory are synced to disk before returning
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmpPath = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as tmpFile:
+            tmpFile.write(content)
+            if durable:
+                tmpFile.flush()
+                os.fsync(tmpFile.fileno())
+        os.replace(tmpPath, path)
+    except Exception:
+        if os.path.exists(tmpPath):
+            os.unlink(tmpPath)
+        raise
+    if durable:
+        dirFd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dirFd)
+        finally:
+            os.close(dirFd)
+
+def saveSnapshot(path, data):
+    """
+        Saves data as json in path, atomically (see atomicWrite)
+    """
     logger = logging.getLogger(__name__)
-    logger.info('%s.setConf starts', __name__)
-    currentPath = os.path.dirname(os.path.abspath(__file__))
-    confPath = currentPath + '/../conf/smartclonner.conf'
-    comments_map = save_comments(confPath)
+    if not path:
+        return
     try:
-        with open(confPath, 'w') as configfile:
-            cfg.write(configfile)
+        atomicWrite(path, json.dumps(data))
     except Exception as e:
-        print(e)
-    restore_comments(confPath, comments_map)
-
-def save_comments(config_file):
-    comment_map = {}
-    with open(config_file, 'r') as file:
-        i = 0
-        lines = file.readlines()
-        for line in lines:
-            if re.match( r'^\s*#.*?$', line):
-                comment_map[i] = line
-            i += 1
-    return comment_map
-
-def restore_comments(config_file, comment_map):
-    with open(config_file, 'r') as file:
-        lines = file.readlines()
-    for (index, comment) in sorted(comment_map.items()):
-        lines.insert(index, comment)
-    with open(config_file, 'w') as file:
-        file.write(''.join(lines))
\ No newline at end of file
+        logger.warning('Failed to save snapshot %s: %s', path, str(e))
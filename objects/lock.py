@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+class InstanceLock:
+    'Single-instance lock held with flock on a lock file, released by the kernel when the process dies'
+
+    def __init__(self, path, heartbeatInterval=0, staleAfter=0):
+        """
+            Class constructor
+
+            :param path: path of the lock file
+            :type path: str
+            :param heartbeatInterval: seconds between two refreshes of the
+                                      heartbeat written in the lock file,
+                                      0 disables the heartbeat
+            :type heartbeatInterval: float
+            :param staleAfter: seconds without heartbeat after which the
+                               holder of the lock is reported as hung,
+                               0 disables the check
+            :type staleAfter: float
+
+            :return: Object InstanceLock
+            :rtype: InstanceLock
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.heartbeatInterval = heartbeatInterval
+        self.staleAfter = staleAfter
+        self.lockFile = None
+        self.startedAt = None
+        self.stop = threading.Event()
+        self.heartbeat = None
+
+    def readHolder(self):
+        """
+            Returns the content written by the holder of the lock
+            (pid, started_at, heartbeat_at), None if unreadable
+        """
+        try:
+            with open(self.path, 'r') as lockFile:
+                return json.loads(lockFile.read())
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self):
+        """
+            Takes the lock without waiting
+
+            :return: True if the lock was taken, False if another instance holds it
+            :rtype: bool
+        """
+        self.logger.info('%s.acquire starts', __name__)
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # the previous content is only read, the file is truncated once locked
+        previous = self.readHolder()
+
+        lockFile = open(self.path, 'a+')
+        try:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lockFile.close()
+            self.reportHolder(self.readHolder())
+            return False
+        except Exception:
+            lockFile.close()
+            raise
+
+        if previous and previous.get('pid') != os.getpid():
+            # the lock file outlived its process (crash, kill -9, OOM)
+            self.logger.warning('Taking over the lock left by pid %s started at %s',
+                previous.get('pid'), previous.get('started_at'))
+
+        self.lockFile = lockFile
+        self.startedAt = int(time.time())
+        self.writeHolder()
+
+        if self.heartbeatInterval > 0:
+            self.stop.clear()
+            self.heartbeat = threading.Thread(target=self.beat,
+                name='lock-heartbeat', daemon=True)
+            self.heartbeat.start()
+        return True
+
+    def reportHolder(self, holder):
+        """
+            Logs the instance holding the lock, as an error when its
+            heartbeat is older than staleAfter
+        """
+        if not holder:
+            self.logger.info('another instance of smartclonner holds %s', self.path)
+            return
+
+        pid = holder.get('pid')
+        heartbeatAt = holder.get('heartbeat_at', holder.get('started_at', 0))
+        age = time.time() - heartbeatAt
+        if self.staleAfter > 0 and age > self.staleAfter:
+            self.logger.error('smartclonner pid %s holds %s but its last heartbeat '
+                'is %d seconds old, it may be hung', pid, self.path, age)
+        else:
+            self.logger.info('another instance of smartclonner (pid %s) holds %s',
+                pid, self.path)
+
+    def writeHolder(self):
+        """
+            Writes the pid and heartbeat of this process in the lock file;
+            the file is rewritten in place since replacing it would drop the lock
+        """
+        self.lockFile.seek(0)
+        self.lockFile.truncate()
+        self.lockFile.write(json.dumps({
+            'pid': os.getpid(),
+            'started_at': self.startedAt,
+            'heartbeat_at': int(time.time())
+        }))
+        self.lockFile.flush()
+
+    def beat(self):
+        """
+            Heartbeat thread: refreshes the lock file every heartbeatInterval
+            seconds until the lock is released
+        """
+        while not self.stop.wait(self.heartbeatInterval):
+            try:
+                self.writeHolder()
+            except Exception as e:
+                self.logger.warning('Failed to refresh the lock heartbeat: %s', str(e))
+
+    def release(self):
+        """
+            Releases the lock; the lock file is kept, removing it could let
+            two instances lock different files
+        """
+        self.logger.info('%s.release starts', __name__)
+
+        if self.lockFile is None:
+            return
+        self.stop.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+        try:
+            self.lockFile.seek(0)
+            self.lockFile.truncate()
+            fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.lockFile.close()
+            self.lockFile = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+import functools
+import logging
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .common import atomicWrite
+
+# seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatLabels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, escapeLabel(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+def formatValue(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+class Counter:
+    'Counter metric, one value per combination of label values'
+
+    def __init__(self, name, documentation, labelNames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def inc(self, *labelValues, value=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s counter' % self.name]
+        with self.lock:
+            for labelValues, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name,
+                    formatLabels(self.labelNames, labelValues), formatValue(value)))
+        return lines
+
+class Histogram:
+    'Histogram metric (cumulative buckets, sum and count), one per combination of label values'
+
+    def __init__(self, name, documentation, labelNames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # label values -> [count per bucket..., count of +Inf, sum]
+        self.values = dict()
+
+    def observe(self, value, *labelValues):
+        with self.lock:
+            state = self.values.get(labelValues)
+            if state is None:
+                state = [0] * (len(self.buckets) + 2)
+                self.values[labelValues] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            else:
+                state[len(self.buckets)] += 1
+            state[-1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for labelValues, state in sorted(self.values.items()):
+                cumulated = 0
+                for bound, count in zip(self.buckets + ('+Inf',), state):
+                    cumulated += count
+                    lines.append('%s_bucket%s %d' % (self.name,
+                        formatLabels(self.labelNames, labelValues, ('le', bound)), cumulated))
+                labels = formatLabels(self.labelNames, labelValues)
+                lines.append('%s_sum%s %s' % (self.name, labels, formatValue(state[-1])))
+                lines.append('%s_count%s %d' % (self.name, labels, cumulated))
+        return lines
+
+class Registry:
+    'Set of metrics exported in the Prometheus text format'
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.metrics = list()
+        self.server = None
+
+    def counter(self, name, documentation, labelNames=()):
+        metric = Counter(name, documentation, labelNames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelNames=(), buckets=DURATION_BUCKETS):
+        metric = Histogram(name, documentation, labelNames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+            Returns the metrics in the Prometheus text exposition format
+        """
+        lines = list()
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def writeTextfile(self, path):
+        """
+            Writes the metrics in path, for the textfile collector of
+            node_exporter; the file is replaced atomically so that the
+            collector never reads a partial file
+        """
+        try:
+            atomicWrite(path, self.render())
+        except Exception as e:
+            self.logger.warning('Failed to write the metrics in %s: %s', path, str(e))
+
+    def serve(self, port, address='127.0.0.1'):
+        """
+            Serves the metrics over http on address:port (any path)
+            from a daemon thread
+        """
+        self.logger.info('%s.serve starts', __name__)
+
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics-http',
+            daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram('smartclonner_stage_duration_seconds',
+    'Duration of the stages of the offense processing', ('stage',))
+STAGE_ERRORS = registry.counter('smartclonner_stage_errors_total',
+    'Stages which raised an exception (timeout for the Ariel searches which timed out)',
+    ('stage', 'error'))
+API_REQUESTS = registry.counter('smartclonner_api_requests_total',
+    'Requests sent to the QRadar and TheHive APIs', ('api', 'method', 'endpoint', 'status'))
+API_SECONDS = registry.histogram('smartclonner_api_request_duration_seconds',
+    'Duration of the requests sent to the QRadar and TheHive APIs', ('api', 'endpoint'))
+API_ERRORS = registry.counter('smartclonner_api_errors_total',
+    'Requests which failed (http status >= 400, timeout or connection error)',
+    ('api', 'endpoint', 'error'))
+API_PAYLOAD_BYTES = registry.histogram('smartclonner_api_payload_bytes',
+    'Size of the request and response bodies', ('api', 'direction'), SIZE_BUCKETS)
+OFFENSES = registry.counter('smartclonner_offenses_total',
+    'Offenses processed, by outcome', ('outcome',))
+
+# path segments holding an id (offense id, search id, alert id...)
+ID_SEGMENT = re.compile(r'^(~.*|.*\d.*)$')
+
+def endpointLabel(path):
+    """
+        Returns the endpoint of path without its query string and with
+        its ids replaced by {id}, to keep the number of series bounded
+    """
+    path = path.split('?', 1)[0].strip('/')
+    return '/'.join('{id}' if ID_SEGMENT.match(segment) else segment
+        for segment in path.split('/'))
+
+def apiObserver(api):
+    """
+        Returns the callback recording the requests sent to api, called by
+        RestApiClient and TheHiveApi with (method, path, status, seconds,
+        requestBytes, responseBytes, error), status being None and error
+        'timeout' or 'connection' when no response was received
+    """
+    def observe(method, path, status, seconds, requestBytes, responseBytes, error=None):
+        endpoint = endpointLabel(path)
+        API_SECONDS.observe(seconds, api, endpoint)
+        API_REQUESTS.inc(api, method, endpoint, str(status) if status is not None else 'none')
+        if error is None and status is not None and status >= 400:
+            error = 'http'
+        if error is not None:
+            API_ERRORS.inc(api, endpoint, error)
+        if requestBytes:
+            API_PAYLOAD_BYTES.observe(requestBytes, api, 'request')
+        if responseBytes is not None:
+            API_PAYLOAD_BYTES.observe(responseBytes, api, 'response')
+    return observe
+
+@contextmanager
+def stage(name):
+    """
+        Records the duration of the enclosed block as stage name,
+        and its exception if it raises
+    """
+    start = time.monotonic()
+    try:
+        yield
+    except TimeoutError:
+        STAGE_ERRORS.inc(name, 'timeout')
+        raise
+    except Exception:
+        STAGE_ERRORS.inc(name, 'error')
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.monotonic() - start, name)
+
+def timed(name):
+    """
+        Decorator recording the duration of each call as stage name
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def setup(cfg):
+    """
+        Starts the http endpoint if [Metrics] http_port is set
+    """
+    port = cfg.getint('Metrics', 'http_port', fallback=0)
+    if port > 0 and registry.server is None:
+        registry.serve(port, cfg.get('Metrics', 'http_address', fallback='127.0.0.1'))
+
+def export(cfg):
+    """
+        Writes the textfile if [Metrics] textfile is set
+    """
+    path = cfg.get('Metrics', 'textfile', fallback='')
+    if path:
+        registry.writeTextfile(path)
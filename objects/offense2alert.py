@@ -6,12 +6,112 @@ import sys
 import logging
 import copy
 import json
+import time
+import heapq
+import itertools
 
-from time import sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from objects.common import getConf, setConf
+from objects.common import getConf
+from objects.checkpoint import loadCheckpoint
+from objects.metrics import OFFENSES, timed
+from objects import profiling
 from objects.qradar_connector import QRadarConnector
 from objects.thehive_connector import TheHiveConnector
+from objects.thehive4py.query import Eq
+
+# source of the alerts raised in TheHive
+ALERT_SOURCE = 'QRadar_Offenses'
+
+class DeferredOffense:
+    'Offense to process again later, its logs not being searchable yet'
+
+    def __init__(self, offense, delay, attempt, enriched):
+        """
+            :param offense: the offense, enriched or as returned by QRadar
+            :type offense: dict
+            :param delay: seconds to wait before processing the offense again
+            :type delay: float
+            :param attempt: number of times the logs have been searched
+            :type attempt: int
+            :param enriched: True if the offense has already been enriched
+            :type enriched: bool
+        """
+        self.offense = offense
+        self.delay = delay
+        self.attempt = attempt
+        self.enriched = enriched
+
+class PendingLogs:
+    'Alert created without its logs (two-phase publishing), which are still to be added to its description'
+
+    def __init__(self, alertId, offense, attempt, delay):
+        """
+            :param alertId: TheHive alert id
+            :type alertId: str
+            :param offense: the enriched offense
+            :type offense: dict
+            :param attempt: number of times the logs have been searched
+            :type attempt: int
+            :param delay: seconds to wait before searching the logs
+            :type delay: float
+        """
+        self.alertId = alertId
+        self.offense = offense
+        self.attempt = attempt
+        self.delay = delay
+
+class DelayQueue:
+    'Items which become available once their delay has elapsed'
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, item, delay):
+        heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), item))
+
+    def popDue(self):
+        """
+            Removes and returns the items which are due
+        """
+        due = []
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[2])
+        return due
+
+    def pending(self):
+        """
+            Returns the items which are not due yet, with the
+            seconds left before they are
+        """
+        now = time.monotonic()
+        return [(item, max(dueAt - now, 0)) for dueAt, _, item in sorted(self.heap)]
+
+def logsReadyIn(qradarConnector, offense):
+    """
+       Returns the seconds to wait before the offense logs are searchable,
+       the events being searchable logs_ready_delay seconds after the
+       offense start_time
+
+       :rtype: float
+    """
+    age = time.time() - offense['start_time'] / 1000.0
+    return max(qradarConnector.logs_ready_delay - age, 0)
+
+def logsRetryable(qradarConnector, offense, attempt):
+    """
+       True if a search which returned no logs is worth retrying,
+       i.e. the offense is recent enough for its events to be late
+    """
+    age = time.time() - offense['start_time'] / 1000.0
+    return (attempt <= qradarConnector.logs_retries and
+        age < qradarConnector.logs_retry_window)
 
 def getEnrichedOffenses(qradarConnector, timerange):
     enrichedOffenses = []
@@ -21,7 +121,8 @@ def getEnrichedOffenses(qradarConnector, timerange):
 
     return enrichedOffenses
 
-def enrichOffense(qradarConnector, offense):
+@timed('enrichment')
+def enrichOffense(qradarConnector, offense, withLogs=True):
 
     enriched = copy.deepcopy(offense)
 
@@ -65,10 +166,13 @@ def enrichOffense(qradarConnector, offense):
     # Add all the observables
     enriched['artifacts'] = artifacts
 
-    # waiting 1s to make sure the logs are searchable
-    sleep(1)
-    # adding the first 3 raw logs
-    enriched['logs'] = qradarConnector.getOffenseLogs(enriched)
+    if qradarConnector.rule_names_tags:
+        enriched['rule_names'] = qradarConnector.getRuleNames(offense)
+
+    # the logs may have been fetched with those of other offenses
+    if withLogs and 'logs' not in enriched:
+        # adding the first raw logs
+        enriched['logs'] = qradarConnector.getOffenseLogs(enriched)
 
     return enriched
 
@@ -99,6 +203,10 @@ def qradarOffenseToHiveAlert(theHiveConnector, offense):
         for cat in offense['categories']:
             tags.append(cat)
 
+    if "rule_names" in offense:
+        for ruleName in offense['rule_names']:
+            tags.append(ruleName)
+
     defaultObservableDatatype = ['autonomous-system', 'domain', 'file', 'filename', 'fqdn', 'hash', 'ip', 'mail', 'mail_subject', 'other', 'regexp', 'registry', 'uri_path', 'url', 'user-agent']
 
     artifacts = []
@@ -121,18 +229,265 @@ def qradarOffenseToHiveAlert(theHiveConnector, offense):
         2,
         'Imported',
         'internal',
-        'QRadar_Offenses',
+        ALERT_SOURCE,
         str(offense['id']),
         artifacts,
         '')
 
     return alert
 
-def allOffense2Alert():
+@timed('offense')
+def offense2Alert(qradarConnector, theHiveConnector, offense, attempt=0, enriched=False,
+        twoPhase=False, deduplicated=False):
+    """
+       Creates an alert in TheHive for a single offense unless
+       the offense has already been imported
+
+       Instead of waiting for the offense logs to be searchable, the
+       offense is returned as a DeferredOffense to be processed again by
+       the next run
+
+       With twoPhase, the alert is created without logs, which are
+       added to its description later (see publishOffense)
+
+       :param offense: offense as returned by QRadar, or as enriched
+                       if processed again
+       :type offense: dict
+       :param attempt: number of times the offense logs have been searched
+       :type attempt: int
+       :param enriched: True if offense has already been enriched
+       :type enriched: bool
+       :param twoPhase: True to create the alert before searching the logs
+       :type twoPhase: bool
+       :param deduplicated: True if the offense is known not to be imported yet
+       :type deduplicated: bool
+
+       :return offense_report: the outcome of the import, None if
+                               the offense was already imported
+       :rtype offense_report: dict or DeferredOffense
+    """
+    logger = logging.getLogger(__name__)
+
+    if not enriched:
+        if attempt == 0 and not deduplicated:
+            # searching if the offense has already been converted to alert
+            logger.info('Looking for offense %s in TheHive alerts', str(offense['id']))
+            if theHiveConnector.alertExists(str(offense['id'])):
+                logger.info('Offense %s already imported as alert', str(offense['id']))
+                return None
+
+        if twoPhase and 'logs' not in offense:
+            return publishOffense(qradarConnector, theHiveConnector, offense)
+
+        delay = logsReadyIn(qradarConnector, offense)
+        if delay > 0 and 'logs' not in offense:
+            logger.info('Offense %s logs not searchable yet, deferred by %.1fs',
+                str(offense['id']), delay)
+            return DeferredOffense(offense, delay, attempt, False)
+
+        enrichedOffense = enrichOffense(qradarConnector, offense)
+    else:
+        enrichedOffense = offense
+        enrichedOffense['logs'] = qradarConnector.getOffenseLogs(enrichedOffense)
+    attempt += 1
+
+    if not enrichedOffense['logs'] and logsRetryable(qradarConnector, enrichedOffense, attempt):
+        logger.info('No logs found for offense %s yet, retrying in %ss',
+            str(offense['id']), qradarConnector.logs_retry_delay)
+        del enrichedOffense['logs']
+        return DeferredOffense(enrichedOffense, qradarConnector.logs_retry_delay, attempt, True)
+
+    return raiseAlert(theHiveConnector, enrichedOffense)[0]
+
+def raiseAlert(theHiveConnector, enrichedOffense):
+    """
+       Creates the alert of an enriched offense in TheHive
+
+       :return: the offense report and the alert, None if the creation failed
+       :rtype: tuple
+    """
+    logger = logging.getLogger(__name__)
+
+    offense_report = dict()
+    try:
+        theHiveAlert = qradarOffenseToHiveAlert(theHiveConnector, enrichedOffense)
+        theHiveEsAlertId = theHiveConnector.createAlert(theHiveAlert)['id']
+        offense_report['raised_alert_id'] = theHiveEsAlertId
+        offense_report['qradar_offense_id'] = enrichedOffense['id']
+        offense_report['success'] = True
+        return offense_report, theHiveAlert
+    except Exception as e:
+        logger.error('%s.raiseAlert failed', __name__, exc_info=True)
+        offense_report['success'] = False
+        offense_report['offense_id'] = enrichedOffense['id']
+        if isinstance(e, ValueError):
+            errorMessage = json.loads(str(e))['message']
+            offense_report['message'] = errorMessage
+        else:
+            offense_report['message'] = str(e) + ": Couldn't raise alert in TheHive"
+        return offense_report, None
+
+def publishOffense(qradarConnector, theHiveConnector, offense):
+    """
+       First phase of the two-phase publishing: creates the alert from
+       the offense and its addresses and records that its logs are still
+       to be added, which attachOffenseLogs does once they are searchable
+
+       :return offense_report: the outcome of the alert creation, with the
+                               PendingLogs to process as 'pending_logs'
+       :rtype offense_report: dict
+    """
+    logger = logging.getLogger(__name__)
+
+    enrichedOffense = enrichOffense(qradarConnector, offense, withLogs=False)
+    offense_report, theHiveAlert = raiseAlert(theHiveConnector, enrichedOffense)
+    if theHiveAlert is None:
+        return offense_report
+
+    # recorded before the logs are searched so that the next run
+    # finishes the alert if this one stops first
+    alertId = offense_report['raised_alert_id']
+    delay = logsReadyIn(qradarConnector, enrichedOffense)
+    try:
+        theHiveConnector.setPendingLogs(alertId, enrichedOffense, 0, time.time() + delay)
+    except Exception as e:
+        logger.error('Failed to record the pending logs of alert %s', alertId, exc_info=True)
+
+    offense_report['pending_logs'] = PendingLogs(alertId, enrichedOffense, 0, delay)
+    return offense_report
+
+def attachOffenseLogs(qradarConnector, theHiveConnector, pending):
+    """
+       Second phase of the two-phase publishing: retrieves the offense
+       logs and updates the description of the alert already created
+
+       :param pending: the alert waiting for its logs
+       :type pending: PendingLogs
+
+       :return: pending to process again after its delay if the logs
+                were not found yet or the update failed, None otherwise
+       :rtype: PendingLogs
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('%s.attachOffenseLogs starts', __name__)
+
+    offense = pending.offense
+    attempt = pending.attempt + 1
+    retryDelay = qradarConnector.logs_retry_delay
+    try:
+        logs = qradarConnector.getOffenseLogs(offense)
+        if not logs and logsRetryable(qradarConnector, offense, attempt):
+            logger.info('No logs found for offense %s yet, retrying in %ss',
+                str(offense['id']), retryDelay)
+            theHiveConnector.setPendingLogs(pending.alertId, offense, attempt,
+                time.time() + retryDelay)
+            return PendingLogs(pending.alertId, offense, attempt, retryDelay)
+
+        alert = qradarOffenseToHiveAlert(theHiveConnector, dict(offense, logs=logs))
+        theHiveConnector.updateAlert(pending.alertId, alert, ['description'])
+        theHiveConnector.removePendingLogs(pending.alertId)
+        logger.info('Logs of offense %s attached to alert %s', str(offense['id']), pending.alertId)
+        return None
+
+    except Exception as e:
+        logger.error('Failed to attach the logs of offense %s to alert %s',
+            str(offense['id']), pending.alertId, exc_info=True)
+
+    if attempt > qradarConnector.logs_retries:
+        logger.error('Giving up attaching the logs of offense %s, alert %s keeps '
+            'its placeholder description', str(offense['id']), pending.alertId)
+        theHiveConnector.removePendingLogs(pending.alertId)
+        return None
+
+    theHiveConnector.setPendingLogs(pending.alertId, offense, attempt, time.time() + retryDelay)
+    return PendingLogs(pending.alertId, offense, attempt, retryDelay)
+
+def prefetchOffenseLogs(qradarConnector, theHiveConnector, offenses, batchSize, deferred=None):
+    """
+       Adds their first raw logs to the offenses not imported yet, fetched
+       by batches of <batchSize> offenses; the offenses already imported
+       are left out before their logs are searched
+
+       :param deferred: offenses deferred by the previous run, known not
+                        to be imported, {offense id: (attempt, due_at)}
+       :type deferred: dict
+
+       :return: offenses not imported yet, with their 'logs'
+       :rtype: generator
+    """
+    logger = logging.getLogger(__name__)
+
+    if deferred is None:
+        deferred = dict()
+
+    batch = []
+    for offense in offenses:
+        if offense['id'] in deferred:
+            # searched with the others once due
+            if deferred[offense['id']][1] <= time.time():
+                batch.append(offense)
+            else:
+                yield offense
+            continue
+        if theHiveConnector.alertExists(str(offense['id'])):
+            logger.info('Offense %s already imported as alert', str(offense['id']))
+            OFFENSES.inc('duplicate')
+            continue
+        batch.append(offense)
+        if len(batch) >= batchSize:
+            for batchOffense in addOffensesLogs(qradarConnector, batch):
+                yield batchOffense
+            batch = []
+    for batchOffense in addOffensesLogs(qradarConnector, batch):
+        yield batchOffense
+
+def addOffensesLogs(qradarConnector, offenses):
+    # the offenses whose logs are not searchable yet will be deferred
+    ready = [offense for offense in offenses if logsReadyIn(qradarConnector, offense) == 0]
+    if ready:
+        logsByOffense = qradarConnector.getOffensesLogs(ready)
+        for offense in ready:
+            offense['logs'] = logsByOffense[offense['id']]
+    return offenses
+
+def mapOffenses(func, offenses, workers, maxInflight):
+    """
+       Applies func to every offense with a pool of <workers> threads,
+       never having more than <maxInflight> offenses submitted at once
+
+       :return: (offense, result) tuples, in the order of offenses
+       :rtype: generator
+    """
+    if workers <= 1:
+        for offense in offenses:
+            yield offense, func(offense)
+        return
+
+    maxInflight = max(maxInflight, workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        inflight = deque()
+        for offense in offenses:
+            if len(inflight) >= maxInflight:
+                done, future = inflight.popleft()
+                yield done, future.result()
+            inflight.append((offense, executor.submit(func, offense)))
+        while inflight:
+            done, future = inflight.popleft()
+            yield done, future.result()
+
+@timed('run')
+def allOffense2Alert(qradarConnector=None, theHiveConnector=None):
     """
        Get all open offenses created within the last
        <timerange> minutes and creates alerts for them in
        TheHive
+
+       :param qradarConnector: connector to reuse between runs (daemon mode),
+                               a new one is created from the conf if None
+       :type qradarConnector: QRadarConnector
+       :param theHiveConnector: connector to reuse between runs (daemon mode),
+                                a new one is created from the conf if None
+       :type theHiveConnector: TheHiveConnector
     """
     logger = logging.getLogger(__name__)
     logger.info('%s.allOffense2Alert starts', __name__)
@@ -144,48 +499,109 @@ def allOffense2Alert():
     try:
         cfg = getConf()
 
-        qradarConnector = QRadarConnector(cfg)
-        theHiveConnector = TheHiveConnector(cfg)
+        if qradarConnector is None:
+            qradarConnector = QRadarConnector(cfg)
+        if theHiveConnector is None:
+            theHiveConnector = TheHiveConnector(cfg)
+
+        workers = cfg.getint('smartclonner', 'workers', fallback=1)
+        maxInflight = cfg.getint('smartclonner', 'max_inflight_offenses',
+            fallback=2 * workers)
 
-        offensesList = qradarConnector.getOffensesAfter()
+        twoPhasePublish = cfg.getboolean('smartclonner', 'two_phase_publish', fallback=False)
 
-        offenseLastId = int(cfg.get('QRadar', 'offense_id_after'))
+        checkpoint, offenseLastId = loadCheckpoint(cfg)
+        qradarConnector.offense_id_after = str(offenseLastId)
+        logger.info('polling QRadar for offenses after %s', offenseLastId)
+        # the checkpoint being held below them, the offenses deferred
+        # by the previous run are listed again
+        carried = checkpoint.getDeferred()
+
+        # offenses are fetched page by page while the previous ones are processed
+        offensesList = qradarConnector.iterOffensesAfter()
+        prefetch = qradarConnector.aql_batch_size > 1 and not twoPhasePublish
+        if prefetch:
+            offensesList = prefetchOffenseLogs(qradarConnector, theHiveConnector,
+                offensesList, qradarConnector.aql_batch_size, carried)
 
         # each offense in the list is represented as a dict
         # we enrich this dict with additional details
-        for offense in offensesList:
-            # searching if the offense has already been converted to alert
-            q = dict()
-            q['sourceRef'] = str(offense['id'])
-            logger.info('Looking for offense %s in TheHive alerts', str(offense['id']))
-            results = theHiveConnector.findAlert(q)
-            if len(results) == 0:
-                offense_report = dict()
-                enrichedOffense = enrichOffense(qradarConnector, offense)
-                try:
-                    theHiveAlert = qradarOffenseToHiveAlert(theHiveConnector, enrichedOffense)
-                    theHiveEsAlertId = theHiveConnector.createAlert(theHiveAlert)['id']
-                    offense_report['raised_alert_id'] = theHiveEsAlertId
-                    offense_report['qradar_offense_id'] = offense['id']
-                    offense_report['success'] = True
-                    if offenseLastId < offense['id']:
-                        offenseLastId = offense['id']
-                except Exception as e:
-                    logger.error('%s.allOffense2Alert failed', __name__, exc_info=True)
+        # returns the offense id with the outcome, for the outcome may be None
+        def cloneOffense(offense):
+            if isinstance(offense, PendingLogs):
+                return None, attachOffenseLogs(qradarConnector, theHiveConnector, offense)
+            if isinstance(offense, DeferredOffense):
+                # the offense was known not to be imported when deferred
+                with profiling.profiled('offense', 'offense-%s' % offense.offense['id']):
+                    return offense.offense['id'], offense2Alert(qradarConnector,
+                        theHiveConnector, offense.offense, offense.attempt,
+                        offense.enriched, deduplicated=True)
+            attempt, dueAt = carried.get(offense['id'], (0, 0))
+            if dueAt > time.time():
+                return offense['id'], DeferredOffense(offense, dueAt - time.time(),
+                    attempt, False)
+            with profiling.profiled('offense', 'offense-%s' % offense['id']):
+                return offense['id'], offense2Alert(qradarConnector, theHiveConnector,
+                    offense, attempt, twoPhase=twoPhasePublish,
+                    deduplicated=prefetch or offense['id'] in carried)
+
+        # offenses whose logs are not searchable yet,
+        # and alerts whose logs are still to be attached
+        deferredOffenses = DelayQueue()
+        # the checkpoint never goes past a deferred offense
+        deferredIds = set()
+
+        # including the log attachments left by the previous runs
+        for alertId, offense, attempt, dueAt in theHiveConnector.getPendingLogs():
+            deferredOffenses.put(PendingLogs(alertId, offense, attempt, 0),
+                max(dueAt - time.time(), 0))
+
+        while True:
+            for offense, (offenseId, offense_report) in mapOffenses(cloneOffense,
+                    offensesList, workers, maxInflight):
+                if isinstance(offense, PendingLogs):
+                    if offense_report is not None:
+                        deferredOffenses.put(offense_report, offense_report.delay)
+                    continue
+                if offense_report is None:
+                    OFFENSES.inc('duplicate')
+                    deferredIds.discard(offenseId)
+                    continue
+                if isinstance(offense_report, DeferredOffense):
+                    OFFENSES.inc('deferred')
+                    deferredOffenses.put(offense_report, offense_report.delay)
+                    deferredIds.add(offense_report.offense['id'])
+                    continue
+                OFFENSES.inc('imported' if offense_report['success'] else 'failed')
+                pending = offense_report.pop('pending_logs', None)
+                if pending is not None:
+                    deferredOffenses.put(pending, pending.delay)
+                if offense_report['success']:
+                    deferredIds.discard(offense_report['qradar_offense_id'])
+                    if offenseLastId < offense_report['qradar_offense_id']:
+                        offenseLastId = offense_report['qradar_offense_id']
+                else:
+                    deferredIds.discard(offense_report['offense_id'])
                     report['success'] = False
-                    offense_report['success'] = False
-                    offense_report['offense_id'] = offense['id']
-                    if isinstance(e, ValueError):
-                        errorMessage = json.loads(str(e))['message']
-                        offense_report['message'] = errorMessage
-                    else:
-                        offense_report['message'] = str(e) + ": Couldn't raise alert in TheHive"
                 report['offenses'].append(offense_report)
-            else:
-                logger.info('Offense %s already imported as alert', str(offense['id']))
 
-        cfg['QRadar']['offense_id_after'] = str(offenseLastId)
-        setConf(cfg)
+                # progress is recorded after every offense
+                if deferredIds:
+                    checkpoint.advance(min(offenseLastId, min(deferredIds) - 1))
+                else:
+                    checkpoint.advance(offenseLastId)
+
+            # nothing is waited for, the offenses and log attachments which
+            # are not due yet are left to the next run: the offenses through
+            # the checkpoint, the attachments through the alert index
+            offensesList = deferredOffenses.popDue()
+            if not offensesList:
+                break
+
+        checkpoint.defer(dict((item.offense['id'], (item.attempt, time.time() + delay))
+            for item, delay in deferredOffenses.pending() if isinstance(item, DeferredOffense)))
+
+        qradarConnector.saveCaches()
 
     except Exception as e:
         logger.error('Failed to create alert from QRadar offense (retrieving offenses failed)', exc_info=True)
@@ -194,6 +610,22 @@ def allOffense2Alert():
 
     return report
 
+def reindexAlerts():
+    """
+       Rebuilds the local alert index from the alerts
+       already raised in TheHive
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('%s.reindexAlerts starts', __name__)
+
+    cfg = getConf()
+    theHiveConnector = TheHiveConnector(cfg)
+    count = theHiveConnector.reconcileAlertIndex(Eq('source', ALERT_SOURCE))
+    logger.info('%s alerts indexed', count)
+
+    return count
+
+@timed('description_rendering')
 def craftAlertDescription(offense):
     """
         From the offense metadata, crafts a nice description in markdown
@@ -220,9 +652,39 @@ def craftAlertDescription(offense):
         '| **Source Network**      | ' + str(offense['source_network']) + ' |\n\n\n' +
         '\n\n\n\n```\n')
 
-    for log in offense['logs']:
-        description += log['utf8_payload'] + '\n'
+    if 'logs' in offense:
+        description += craftLogs(offense['logs'],
+            cfg.getint('QRadar', 'log_max_bytes', fallback=2048),
+            cfg.getint('QRadar', 'logs_max_bytes', fallback=8192))
+    else:
+        # two-phase publishing, the logs are added once retrieved
+        description += 'Retrieving the raw logs from QRadar...\n'
 
     description += '```\n\n' + url
 
     return description
+
+def craftLogs(logs, logMaxBytes, logsMaxBytes):
+    """
+        Joins the raw logs, each log being truncated to logMaxBytes
+        and the logs to logsMaxBytes in total (0 for no limit)
+    """
+    description = ''
+    totalBytes = 0
+    for index, log in enumerate(logs):
+        # payload_length being the length of the payload before QRadar truncated it
+        truncated = len(log['utf8_payload']) < log.get('payload_length', 0)
+        payload = log['utf8_payload'].encode('utf-8')
+        if logMaxBytes > 0 and len(payload) > logMaxBytes:
+            payload = payload[:logMaxBytes]
+            truncated = True
+        if logsMaxBytes > 0 and totalBytes + len(payload) > logsMaxBytes:
+            description += '[%d more logs truncated]\n' % (len(logs) - index)
+            break
+        totalBytes += len(payload)
+        description += payload.decode('utf-8', 'ignore')
+        if truncated:
+            description += ' [truncated]'
+        description += '\n'
+
+    return description
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+import cProfile
+import glob
+import logging
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+from .common import resolvePath
+
+# environment variable enabling the profiling, as smart_cloner.py --profile
+PROFILE_ENV = 'SMARTCLONNER_PROFILE'
+SCOPES = ('run', 'offense')
+
+class StackSampler:
+    'Samples the stacks of the running threads, counted as collapsed stacks for flamegraphs'
+
+    def __init__(self, interval, threadId=None):
+        """
+            Class constructor
+
+            :param interval: seconds between two samples
+            :type interval: float
+            :param threadId: identifier of the only thread sampled,
+                             every thread is sampled if None
+            :type threadId: int
+
+            :return: Object StackSampler
+            :rtype: StackSampler
+        """
+
+        self.interval = interval
+        self.threadId = threadId
+        self.stacks = Counter()
+        self.stop = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='profile-sampler', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        ownId = threading.get_ident()
+        while not self.stop.wait(self.interval):
+            for threadId, frame in sys._current_frames().items():
+                if threadId == ownId:
+                    continue
+                if self.threadId is not None and threadId != self.threadId:
+                    continue
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name,
+                        os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def close(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def write(self, path):
+        """
+            Writes the samples in the collapsed format ("frame;frame count")
+            read by flamegraph.pl and speedscope
+        """
+        with open(path, 'w') as foldedFile:
+            for stack, count in self.stacks.most_common():
+                foldedFile.write('%s %d\n' % (stack, count))
+
+class Profiler:
+    'Writes a cProfile .pstats and a collapsed-stack .folded file per profiled block'
+
+    def __init__(self, scope, directory, keep=20, sampleInterval=0.005):
+        """
+            Class constructor
+
+            :param scope: 'run' to profile each run, 'offense' to
+                          profile each offense
+            :type scope: str
+            :param directory: directory of the profiles
+            :type directory: str
+            :param keep: number of profiles kept, the oldest are removed
+            :type keep: int
+            :param sampleInterval: seconds between two stack samples
+            :type sampleInterval: float
+
+            :return: Object Profiler
+            :rtype: Profiler
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.scope = scope
+        self.directory = directory
+        self.keep = keep
+        self.sampleInterval = sampleInterval
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, name):
+        """
+            Profiles the enclosed block; cProfile only sees the calling
+            thread, so with several workers a run profile holds the main
+            thread only while its samples cover every thread
+        """
+        profile = cProfile.Profile()
+        sampler = StackSampler(self.sampleInterval,
+            threading.get_ident() if self.scope == 'offense' else None)
+        sampler.start()
+        try:
+            profile.enable()
+        except ValueError:
+            # python >= 3.12 allows one active cProfile at a time, the
+            # other offenses processed concurrently are only sampled
+            profile = None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            sampler.close()
+            try:
+                self.write(name, profile, sampler)
+            except Exception as e:
+                self.logger.warning('Failed to write the profile of %s: %s', name, str(e))
+
+    def write(self, name, profile, sampler):
+        os.makedirs(self.directory, exist_ok=True)
+        basePath = os.path.join(self.directory, '%s-%s-%d' % (name,
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        with self.lock:
+            sampler.write(basePath + '.folded')
+            if profile is not None:
+                profile.dump_stats(basePath + '.pstats')
+            self.logger.info('profile written in %s', basePath)
+            self.rotate()
+
+    def rotate(self):
+        """
+            Removes the oldest profiles beyond keep
+        """
+        profiles = sorted(glob.glob(os.path.join(self.directory, '*.folded')),
+            key=os.path.getmtime)
+        for path in profiles[:max(len(profiles) - self.keep, 0)]:
+            for oldPath in (path, path[:-len('.folded')] + '.pstats'):
+                if os.path.exists(oldPath):
+                    os.unlink(oldPath)
+
+profiler = None
+
+def setup(cfg, scope=None):
+    """
+        Enables the profiling if scope (smart_cloner.py --profile) or
+        the SMARTCLONNER_PROFILE environment variable is set, to 'run'
+        or 'offense' ('1' standing for 'run')
+    """
+    global profiler
+
+    logger = logging.getLogger(__name__)
+
+    if scope is None:
+        scope = os.environ.get(PROFILE_ENV, '')
+    if scope in ('', '0'):
+        return
+    if scope == '1':
+        scope = 'run'
+    if scope not in SCOPES:
+        logger.error('Unknown profiling scope %s, should be one of %s', scope, ', '.join(SCOPES))
+        return
+
+    profiler = Profiler(scope,
+        resolvePath(cfg.get('Profiling', 'directory', fallback='profiles')),
+        cfg.getint('Profiling', 'keep', fallback=20),
+        cfg.getfloat('Profiling', 'sample_interval', fallback=0.005))
+    logger.info('profiling every %s in %s', scope, profiler.directory)
+
+@contextmanager
+def profiled(scope, name):
+    """
+        Profiles the enclosed block as name if the profiling is enabled
+        for scope, runs it as is otherwise
+    """
+    if profiler is None or profiler.scope != scope:
+        yield
+        return
+    with profiler.profile(name):
+        yield
@@ -3,8 +3,19 @@
 import logging
 from .qradar_objects.rest_api_client import RestApiClient
 from .qradar_objects.ariel_api_client import APIClient
+from .qradar_objects.ariel_search import wait_for_search, cancel_search, SearchManager
+from .common import resolvePath
+from .cache import LRUCache, Catalogue
+from .metrics import apiObserver, stage, timed
 import time, json
-from multiprocessing import Process, Queue
+import threading
+from urllib.parse import quote
+
+# offense fields read by enrichOffense, qradarOffenseToHiveAlert
+# and craftAlertDescription, the others are not requested
+OFFENSE_FIELDS = ('id,description,severity,start_time,offense_type,offense_source,'
+    'source_address_ids,local_destination_address_ids,destination_networks,'
+    'source_network,categories,rules(id,type)')
 
 class QRadarConnector:
     'QRadar connector'
@@ -25,9 +36,70 @@ class QRadarConnector:
         clients = self.getClients()
         self.client = clients[0]
         self.arielClient = clients[1]
+        #set from the checkpoint by allOffense2Alert before each run
         self.offense_id_after = "-1"
-        if self.cfg.has_option('QRadar', 'offense_id_after'):
-            self.offense_id_after = self.cfg.get('QRadar', 'offense_id_after')
+        self.offense_page_size = self.cfg.getint('QRadar', 'offense_page_size', fallback=100)
+        #fields projection for offense queries, "*" requests every field
+        self.offense_fields = self.cfg.get('QRadar', 'offense_fields', fallback='') or OFFENSE_FIELDS
+        if self.offense_fields == '*':
+            self.offense_fields = None
+        self.address_batch_size = self.cfg.getint('QRadar', 'address_batch_size', fallback=50)
+        self.address_lookup_timeout = self.cfg.getfloat('QRadar', 'address_lookup_timeout', fallback=3)
+
+        #address id to ip cache, keys being "<path>/<id>"
+        self.addressCache = LRUCache(
+            self.cfg.getint('QRadar', 'address_cache_size', fallback=10000),
+            self.cfg.getfloat('QRadar', 'address_cache_ttl', fallback=86400))
+        self.address_cache_file = resolvePath(
+            self.cfg.get('QRadar', 'address_cache_file', fallback=''))
+        self.addressCache.load(self.address_cache_file)
+
+        #offense types catalogue, {offense type id: offense type name}
+        self.offenseTypes = Catalogue('offense types',
+            lambda: self.getCatalogue('siem/offense_types', 'name'),
+            self.cfg.getfloat('QRadar', 'offense_types_ttl', fallback=3600),
+            resolvePath(self.cfg.get('QRadar', 'offense_types_cache', fallback='')))
+        #unknown ids not found by QRadar since the last catalogue load
+        self.offenseTypesMissing = set()
+        self.offenseTypesMissingAt = 0
+        #unknown ids being looked up, {offense type id: Event set once done}
+        self.offenseTypesLookups = dict()
+        self.offenseTypesLock = threading.Lock()
+
+        #rules catalogue, {rule id: rule name}
+        self.rules = Catalogue('rules',
+            lambda: self.getCatalogue('siem/analytics/rules', 'name'),
+            self.cfg.getfloat('QRadar', 'rules_ttl', fallback=3600),
+            resolvePath(self.cfg.get('QRadar', 'rules_cache', fallback='')),
+            self.cfg.getfloat('QRadar', 'rules_refresh_interval', fallback=60))
+        self.rule_names_tags = self.cfg.getboolean('QRadar', 'rule_names_tags', fallback=False)
+
+        self.aql_search_timeout = self.cfg.getfloat('QRadar', 'aql_search_timeout', fallback=60)
+        self.aql_batch_size = self.cfg.getint('QRadar', 'aql_batch_size', fallback=1)
+        self.logs_count = self.cfg.getint('QRadar', 'logs_count', fallback=3)
+        self.log_max_bytes = self.cfg.getint('QRadar', 'log_max_bytes', fallback=2048)
+
+        #offense logs are searched once logs_ready_delay seconds have elapsed
+        #since the offense start_time, empty searches for offenses younger than
+        #logs_retry_window seconds are retried logs_retries times
+        self.logs_ready_delay = self.cfg.getfloat('QRadar', 'logs_ready_delay', fallback=30)
+        self.logs_retries = self.cfg.getint('QRadar', 'logs_retries', fallback=2)
+        self.logs_retry_delay = self.cfg.getfloat('QRadar', 'logs_retry_delay', fallback=30)
+        self.logs_retry_window = self.cfg.getfloat('QRadar', 'logs_retry_window', fallback=900)
+        self.aql_batch_window = self.cfg.getfloat('QRadar', 'aql_batch_window', fallback=3600)
+        self.aql_poll_min_delay = self.cfg.getfloat('QRadar', 'aql_poll_min_delay', fallback=0.2)
+        self.aql_poll_max_delay = self.cfg.getfloat('QRadar', 'aql_poll_max_delay', fallback=5)
+
+        #searches of concurrent callers overlap through the search manager,
+        #up to aql_max_concurrent_searches at once (0 = no search manager)
+        self.searchManager = None
+        aql_max_concurrent_searches = self.cfg.getint('QRadar', 'aql_max_concurrent_searches', fallback=0)
+        if aql_max_concurrent_searches > 0:
+            self.searchManager = SearchManager(self.arielClient,
+                aql_max_concurrent_searches,
+                self.aql_search_timeout,
+                self.aql_poll_min_delay,
+                self.aql_poll_max_delay)
 
     def getClients(self):
 
@@ -49,15 +121,24 @@ class QRadarConnector:
                 cert_filepath = self.cfg.get('QRadar', 'cert_filepath')
             api_version = self.cfg.get('QRadar', 'api_version')
 
+            pool_options = {
+                'pool_size': self.cfg.getint('QRadar', 'pool_size', fallback=4),
+                'connect_timeout': self.cfg.getfloat('QRadar', 'connect_timeout', fallback=10),
+                'read_timeout': self.cfg.getfloat('QRadar', 'read_timeout', fallback=60),
+                'observer': apiObserver('qradar')
+            }
+
             client = RestApiClient(server,
                 auth_token,
                 cert_filepath,
-                api_version)
+                api_version,
+                **pool_options)
 
             arielClient = APIClient(server,
                 auth_token,
                 cert_filepath,
-                api_version)
+                api_version,
+                **pool_options)
 
             clients = list()
             clients.append(client)
@@ -69,6 +150,16 @@ class QRadarConnector:
             self.logger.error('Failed to get QRadar client', exc_info=True)
             raise
 
+    def close(self):
+        """
+            Closes the connections kept alive to QRadar
+        """
+
+        if self.searchManager is not None:
+            self.searchManager.close()
+        self.client.close()
+        self.arielClient.close()
+
     def getOffensesAfter(self):
         """
             Returns all offenses within a list after offense ID
@@ -84,7 +175,7 @@ class QRadarConnector:
 
         try:
             params = {
-                # 'fields': 'id,status,description',
+                'fields': self.offense_fields,
                 'sort': '+id',
                 'filter': 'id>' + str(self.offense_id_after) + ' and status=OPEN'
             }
@@ -110,6 +201,53 @@ class QRadarConnector:
             self.logger.error('getOffenses failed', exc_info=True)
             raise
 
+    def iterOffensesAfter(self, pageSize=None):
+        """
+            Yields all open offenses after offense ID, fetching them by
+            pages of pageSize offenses (keyset pagination on the id)
+
+            :param pageSize: number of offenses per request, defaults
+                             to offense_page_size
+            :type pageSize: int
+
+            :return: offenses, one offense being a dict
+            :rtype: generator
+        """
+
+        self.logger.info('%s.iterOffensesAfter starts', __name__)
+
+        if pageSize is None:
+            pageSize = self.offense_page_size
+
+        lastId = self.offense_id_after
+        while True:
+            params = {
+                'fields': self.offense_fields,
+                'sort': '+id',
+                'filter': 'id>' + str(lastId) + ' and status=OPEN'
+            }
+            headers = {
+                'Range': 'items=0-%d' % (pageSize - 1)
+            }
+            query = 'siem/offenses'
+            self.logger.debug('%s after %s', query, lastId)
+            with stage('offense_listing'):
+                response = self.client.call_api(query, 'GET', headers=headers, params=params)
+
+                self.logger.debug('response code=%s', str(response.code))
+                if response.code not in (200, 206):
+                    self.logger.error('%s.iterOffensesAfter failed, api call returned http %s',
+                        __name__, str(response.code))
+                    raise ValueError(response.msg)
+
+                page = json.load(response)
+            for offense in page:
+                yield offense
+
+            if len(page) < pageSize:
+                return
+            lastId = page[-1]['id']
+
     def getOffenses(self, timerange):
         """
             Returns all offenses within a list
@@ -142,6 +280,8 @@ class QRadarConnector:
             # %3C <=> <
             # moreover we filter on OPEN offenses only
             query = 'siem/offenses?filter=last_updated_time%3E' + str(timeFilter) + '%20and%20last_updated_time%3C' + str(now) + '%20and%20status%3DOPEN'
+            if self.offense_fields:
+                query += '&fields=' + quote(self.offense_fields)
             self.logger.debug(query)
             response = self.client.call_api(
                 query, 'GET')
@@ -215,70 +355,138 @@ class QRadarConnector:
             self.logger.error('getOffenses failed', exc_info=True)
             raise
 
-    def getAddressesFromIDs(self, path, field, ids, queue):
-        #using queue to implement a timeout mecanism
-        #useful if there are more than 50 IPs to look up
+    def getAddressesFromIDs(self, path, field, ids, timeout=None):
+        """
+            Returns the addresses for the given address ids
+
+            :param path: siem endpoint, either source_addresses or
+                         local_destination_addresses
+            :type path: str
+            :param field: field holding the address in the endpoint's objects
+            :type field: str
+            :param ids: address ids
+            :type ids: list
+            :param timeout: overall deadline in seconds for the lookup,
+                            no deadline if None
+            :type timeout: float
+
+            :return address_strings: the addresses resolved before the
+                                     deadline or before an error occurred
+            :rtype address_strings: list
+        """
         self.logger.debug("Looking up %s with %s IDs..." % (path,ids))
 
         address_strings = []
 
+        #ids already resolved do not cost any api call
+        unresolved = []
         for address_id in ids:
+            address = self.addressCache.get('%s/%s' % (path, address_id))
+            if address is None:
+                unresolved.append(address_id)
+            else:
+                address_strings.append(address)
+        ids = unresolved
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        #addresses are resolved by chunks of address_batch_size ids,
+        #one filtered list query per chunk instead of one query per id
+        for i in range(0, len(ids), self.address_batch_size):
+            chunk = ids[i:i + self.address_batch_size]
+            params = {
+                'filter': 'id in (%s)' % ','.join(str(address_id) for address_id in chunk),
+                'fields': 'id,%s' % field
+            }
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.logger.warning('%s.getAddressesFromIDs took too long, %s ids of path %s not resolved',
+                        __name__, len(ids) - i, path)
+                    break
+
             try:
-                response = self.client.call_api('siem/%s/%s' % (path, address_id), 'GET')
+                response = self.client.call_api('siem/%s' % path, 'GET', params=params, timeout=remaining)
                 response_text = response.read().decode('utf-8')
                 response_body = json.loads(response_text)
 
-                try:
-                    if response.code == 200:
-                        address_strings.append(response_body[field])
-                    else:
-                        self.logger.warning("Couldn't get id %s from path %s (response code %s)" % (address_id, path, response.code))
-
-                except Exception as e:
-                    self.logger.error('%s.getAddressFromIDs failed', __name__, exc_info=True)
-                    raise e
+                if response.code == 200:
+                    for address in response_body:
+                        address_strings.append(address[field])
+                        self.addressCache.put('%s/%s' % (path, address['id']), address[field])
+                    if len(response_body) != len(chunk):
+                        self.logger.warning("Got %s addresses out of %s ids from path %s" % (len(response_body), len(chunk), path))
+                else:
+                    self.logger.warning("Couldn't get ids %s from path %s (response code %s)" % (chunk, path, response.code))
 
             except Exception as e:
-                self.logger.error('%s.getAddressFromIDs failed', __name__, exc_info=True)
-                raise e
+                #keeping the addresses resolved so far
+                self.logger.error('%s.getAddressFromIDs failed, %s ids of path %s not resolved',
+                    __name__, len(ids) - i, path, exc_info=True)
+                break
+
+        return address_strings
+
+    def saveCaches(self):
+        """
+            Persists the address cache so that the next run starts warm
+        """
 
-        queue.put(address_strings)
-        # return address_strings
+        self.logger.info('%s.saveCaches starts, address cache: %s', __name__,
+            self.addressCache.stats())
+        self.addressCache.save(self.address_cache_file)
 
+    @timed('address_lookup')
     def getSourceIPs(self, offense):
         if not "source_address_ids" in offense:
             return []
 
-        queue = Queue()
-        proc = Process(target=self.getAddressesFromIDs, args=("source_addresses", "source_ip", offense["source_address_ids"], queue))
-        proc.start()
-        # return self.getAddressesFromIDs("source_addresses", "source_ip", offense["source_address_ids"])
-        try:
-            res = queue.get(timeout=3)
-            proc.join()
-            return res
-        except:
-            proc.terminate()
-            self.logger.error('%s.getSourceIPs took too long, aborting', __name__, exc_info=True)
-            return []
+        return self.getAddressesFromIDs("source_addresses", "source_ip",
+            offense["source_address_ids"], self.address_lookup_timeout)
 
+    @timed('address_lookup')
     def getLocalDestinationIPs(self, offense):
         if not "local_destination_address_ids" in offense:
             return []
 
-        queue = Queue()
-        proc = Process(target=self.getAddressesFromIDs, args=("local_destination_addresses", "local_destination_ip", offense["local_destination_address_ids"], queue,))
-        proc.start()
-        # return self.getAddressesFromIDs("local_destination_addresses", "local_destination_ip", offense["local_destination_address_ids"])
-        try:
-            res = queue.get(timeout=3)
-            proc.join()
-            return res
-        except:
-            proc.terminate()
-            self.logger.error('%s.getLocalDestinationIPs took too long, aborting', __name__, exc_info=True)
-            return []
+        return self.getAddressesFromIDs("local_destination_addresses", "local_destination_ip",
+            offense["local_destination_address_ids"], self.address_lookup_timeout)
+
+    def getCatalogue(self, endpoint, field):
+        """
+            Returns a whole QRadar catalogue (offense types, rules...)
+            as a dict
+
+            :param endpoint: the list endpoint, e.g. siem/offense_types
+            :type endpoint: str
+            :param field: the field to map the object ids to
+            :type field: str
+
+            :return catalogue: {object id: object field}
+            :rtype catalogue: dict
+        """
+
+        self.logger.info('%s.getCatalogue starts', __name__)
+
+        params = {
+            'fields': 'id,' + field
+        }
+        response = self.client.call_api(endpoint, 'GET', params=params)
+        response_text = response.read().decode('utf-8')
+        response_body = json.loads(response_text)
+
+        if response.code != 200:
+            self.logger.error('getCatalogue %s failed, api returned http %s',
+                endpoint, str(response.code))
+            raise ValueError(json.dumps(response_body, indent=4))
 
+        return dict((item['id'], item[field]) for item in response_body)
+
+    @timed('offense_type_lookup')
     def getOffenseTypeStr(self, offenseTypeId):
         """
             Returns the offense type as string given the offense type id
@@ -292,9 +500,34 @@ class QRadarConnector:
 
         self.logger.info('%s.getOffenseTypeStr starts', __name__)
 
+        offenseTypes = self.offenseTypes.get()
+        if offenseTypeId in offenseTypes:
+            return offenseTypes[offenseTypeId]
+
         offenseTypeStr = 'Unknown offense_type name for id=' + \
             str(offenseTypeId)
 
+        while True:
+            with self.offenseTypesLock:
+                if self.offenseTypesMissingAt != self.offenseTypes.loadedAt:
+                    #the catalogue has been reloaded since
+                    self.offenseTypesMissing = set()
+                    self.offenseTypesMissingAt = self.offenseTypes.loadedAt
+                if offenseTypeId in self.offenseTypesMissing:
+                    return offenseTypeStr
+                lookup = self.offenseTypesLookups.get(offenseTypeId)
+                if lookup is None:
+                    lookup = threading.Event()
+                    self.offenseTypesLookups[offenseTypeId] = lookup
+                    break
+            #the id is being looked up by another thread, whose lookup
+            #is made again here only if it failed without an answer
+            lookup.wait()
+            offenseTypes = self.offenseTypes.get()
+            if offenseTypeId in offenseTypes:
+                return offenseTypes[offenseTypeId]
+
+        #unknown id, falling back to a single lookup
         try:
             response = self.client.call_api(
                 'siem/offense_types?filter=id%3D' + str(offenseTypeId),
@@ -316,6 +549,7 @@ class QRadarConnector:
             try:
                 if response.code == 200:
                     offenseTypeStr = response_body[0]['name']
+                    self.offenseTypes.add(offenseTypeId, offenseTypeStr)
                 else:
                     self.logger.error(
                         'getOffenseTypeStr failed, api returned http %s',
@@ -330,15 +564,23 @@ class QRadarConnector:
                 #I saw this happened in QRadar CE for offense type:
                 # 3, 4, 5, 6, 7, 12, 13, 15
                 self.logger.warning('%s; response_body empty', __name__)
+                #not looked up again until the catalogue is reloaded
+                with self.offenseTypesLock:
+                    self.offenseTypesMissing.add(offenseTypeId)
                 return offenseTypeStr
 
         except Exception as e:
             self.logger.error('%s.getOffenseTypeStr failed', __name__, exc_info=True)
             raise
 
+        finally:
+            with self.offenseTypesLock:
+                del self.offenseTypesLookups[offenseTypeId]
+            lookup.set()
+
     def getOffenseLogs(self, offense):
         """
-            Returns the first 3 raw logs for a given offense
+            Returns the first logs_count raw logs for a given offense
 
             :param offense: offense in QRadar
             :type offense: dict
@@ -356,19 +598,18 @@ class QRadarConnector:
             # on the time window's edges
             #if the window is [14:10 ; 14:20]
             #it should be changes to [14:09 ; 14:21]
-            #moreover, since only the first 3 logs are returned
+            #moreover, since only the first few logs are returned
             #no need to use last_updated_time (which might be way after start_time
             #and so consume resource for the search)
             #as such search window is [start_time - 1 ; start_time +5]
-            start_time = (offense['start_time'] - 1 * 60 * 1000)
-            last_updated_time = (offense['start_time'] + 5 * 60 * 1000)
+            start_time, last_updated_time = self.getLogsWindow(offense)
 
             start_timeStr = self.convertMilliEpoch2str(start_time)
             last_updated_timeStr = self.convertMilliEpoch2str(
                 last_updated_time
             )
 
-            query = ("select  DATEFORMAT(starttime,'YYYY-MM-dd HH:mm:ss') as Date, UTF8(payload) from events where INOFFENSE('" + str(offenseId) + "') ORDER BY Date ASC  LIMIT 3 START '" + start_timeStr + "' STOP '" + last_updated_timeStr + "';")
+            query = ("select " + self.getLogsColumns() + " from events where INOFFENSE('" + str(offenseId) + "') ORDER BY Date ASC  LIMIT " + str(self.logs_count) + " START '" + start_timeStr + "' STOP '" + last_updated_timeStr + "';")
 
             self.logger.debug(query)
             response = self.aqlSearch(query)
@@ -393,11 +634,131 @@ class QRadarConnector:
             logs = response['events']
             return logs
 
+        except TimeoutError as e:
+            #a slow search must not block the alert creation
+            self.logger.warning('%s.getOffenseLogs: %s, no logs for offense %s',
+                __name__, str(e), offense['id'])
+            return []
 
         except Exception as e:
             self.logger.error('%s.getOffenseLogs failed', __name__, exc_info=True)
             raise
 
+    def getLogsColumns(self):
+        """
+            Returns the columns selected by the offense logs searches:
+            the date and the payload, truncated to log_max_bytes characters
+            by QRadar (payload_length being the full payload length)
+        """
+        columns = "DATEFORMAT(starttime,'YYYY-MM-dd HH:mm:ss') as Date, "
+        if self.log_max_bytes > 0:
+            columns += ('SUBSTRING(UTF8(payload), 0, ' + str(self.log_max_bytes) + ') as utf8_payload, ' +
+                'STRLEN(UTF8(payload)) as payload_length')
+        else:
+            columns += 'UTF8(payload)'
+        return columns
+
+    def getLogsWindow(self, offense):
+        """
+            Returns the search window of the offense logs
+            as [start_time - 1 ; start_time + 5] (see getOffenseLogs)
+
+            :return: window start and stop, in milliseconds since epoch
+            :rtype: tuple
+        """
+        return (offense['start_time'] - 1 * 60 * 1000,
+            offense['start_time'] + 5 * 60 * 1000)
+
+    def getOffensesLogs(self, offenses):
+        """
+            Returns the first logs_count raw logs of several offenses, fetched with
+            one search per batch of aql_batch_size offenses whose search
+            windows fit within aql_batch_window seconds
+
+            :param offenses: offenses in QRadar
+            :type offenses: list
+
+            :return logsByOffense: {offense id: logs}
+            :rtype logsByOffense: dict
+        """
+
+        self.logger.info('%s.getOffensesLogs starts', __name__)
+
+        logsByOffense = dict()
+
+        batch = []
+        for offense in sorted(offenses, key=lambda offense: offense['start_time']):
+            if batch and (len(batch) >= self.aql_batch_size or
+                    self.getLogsWindow(offense)[1] - self.getLogsWindow(batch[0])[0] >
+                    self.aql_batch_window * 1000):
+                logsByOffense.update(self.getBatchLogs(batch))
+                batch = []
+            batch.append(offense)
+        if batch:
+            logsByOffense.update(self.getBatchLogs(batch))
+
+        return logsByOffense
+
+    def getBatchLogs(self, offenses):
+        """
+            Returns the first logs_count raw logs of each offense with a single
+            search over the offenses' merged search windows
+
+            A noisy offense can use up the shared limit: when the search
+            returned as many events as its limit, the offenses left with fewer
+            than logs_count logs are searched again individually. An event
+            belonging to several offenses of the batch is only returned for
+            the first of them
+
+            :param offenses: offenses in QRadar, sorted by start_time
+            :type offenses: list
+
+            :return logsByOffense: {offense id: logs}
+            :rtype logsByOffense: dict
+        """
+
+        if len(offenses) == 1:
+            return {offenses[0]['id']: self.getOffenseLogs(offenses[0])}
+
+        limit = self.logs_count
+
+        start_time = min(self.getLogsWindow(offense)[0] for offense in offenses)
+        last_updated_time = max(self.getLogsWindow(offense)[1] for offense in offenses)
+
+        #the offense id is projected as a column
+        #to split the events back per offense
+        offenseIdColumn = ('CASE ' +
+            ' '.join("WHEN INOFFENSE('%s') THEN %s" % (offense['id'], offense['id']) for offense in offenses) +
+            ' ELSE 0 END as offense_id')
+        inOffenses = ' OR '.join("INOFFENSE('%s')" % offense['id'] for offense in offenses)
+
+        query = ("select " + offenseIdColumn + ", " + self.getLogsColumns() + " from events where " + inOffenses +
+            " ORDER BY Date ASC  LIMIT " + str(limit * len(offenses)) +
+            " START '" + self.convertMilliEpoch2str(start_time) + "' STOP '" + self.convertMilliEpoch2str(last_updated_time) + "';")
+
+        self.logger.debug(query)
+        try:
+            events = self.aqlSearch(query)['events']
+        except TimeoutError as e:
+            self.logger.warning('%s.getBatchLogs: %s, no logs for offenses %s',
+                __name__, str(e), [offense['id'] for offense in offenses])
+            return dict((offense['id'], []) for offense in offenses)
+
+        logsByOffense = dict((offense['id'], []) for offense in offenses)
+        for event in events:
+            offenseId = event.pop('offense_id')
+            if offenseId in logsByOffense and len(logsByOffense[offenseId]) < limit:
+                logsByOffense[offenseId].append(event)
+
+        #below its limit, the search returned every event of the offenses
+        if len(events) >= limit * len(offenses):
+            for offense in offenses:
+                if len(logsByOffense[offense['id']]) < limit:
+                    logsByOffense[offense['id']] = self.getOffenseLogs(offense)
+
+        return logsByOffense
+
+    @timed('ariel_search')
     def aqlSearch(self, aql_query):
         """
             Perfoms an aqlSearch given an aql_query
@@ -407,25 +768,29 @@ class QRadarConnector:
 
             :return body_json: the result of the aql query
             :rtype offenseTypeStr: dict
+
+            :raises TimeoutError: if the search did not complete within
+                                  aql_search_timeout seconds
         """
 
         self.logger.info('%s.aqlSearch starts', __name__)
         try:
+            if self.searchManager is not None:
+                return self.searchManager.search(aql_query)
+
             response = self.arielClient.create_search(aql_query)
             response_json = json.loads(response.read().decode('utf-8'))
             self.logger.info(response_json)
             search_id = response_json['search_id']
-            response = self.arielClient.get_search(search_id)
-
-            error = False
-            while (response_json['status'] != 'COMPLETED') and not error:
-                if (response_json['status'] == 'EXECUTE') | \
-                        (response_json['status'] == 'SORTING') | \
-                        (response_json['status'] == 'WAIT'):
-                    response = self.arielClient.get_search(search_id)
-                    response_json = json.loads(response.read().decode('utf-8'))
-                else:
-                    error = True
+
+            try:
+                wait_for_search(self.arielClient, search_id,
+                    self.aql_search_timeout,
+                    self.aql_poll_min_delay,
+                    self.aql_poll_max_delay)
+            except ValueError:
+                cancel_search(self.arielClient, search_id)
+                raise
 
             response = self.arielClient.get_search_results(
                 search_id, 'application/json')
@@ -527,7 +892,19 @@ class QRadarConnector:
             self.logger.error('Failed to close offense %s', offenseId, exc_info=True)
             raise
 
+    @timed('rule_names_lookup')
     def getRuleNames(self, offense):
+        """
+            Returns the names of the CRE rules which contributed to
+            the offense, resolved through the rules catalogue
+
+            :param offense: offense in QRadar
+            :type offense: dict
+
+            :return ruleNames: rule names
+            :rtype ruleNames: list
+        """
+
         self.logger.info('%s.getRuleNames starts', __name__)
 
         ruleNames = []
@@ -541,19 +918,11 @@ class QRadarConnector:
                 continue
             if rule['type'] != 'CRE_RULE':
                 continue
-            rule_id = rule['id']
 
-            try:
-                response = self.client.call_api('siem/analytics/rules/%s' % rule_id, 'GET')
-                response_text = response.read().decode('utf-8')
-                response_body = json.loads(response_text)
-
-                if response.code == 200:
-                    ruleNames.append(response_body['name'])
-                else:
-                    self.logger.warning('Could not get rule name for offense')
-
-            except Exception as e:
-                self.logger.warning('Could not get rule name for offense')
+            ruleName = self.rules.lookup(rule['id'])
+            if ruleName is not None:
+                ruleNames.append(ruleName)
+            else:
+                self.logger.warning('Could not get rule name for rule %s', rule['id'])
 
         return ruleNames
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+# Helpers waiting for Ariel searches created with APIClient.create_search,
+# and a manager running several searches concurrently
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# statuses of a search which is still running
+RUNNING_STATUSES = ('WAIT', 'EXECUTE', 'SORTING')
+
+
+def read_json(response):
+    body = json.loads(response.read().decode('utf-8'))
+    if response.code not in (200, 201):
+        raise ValueError(json.dumps(body, indent=4, sort_keys=True))
+    return body
+
+
+def next_poll_delay(search, delay, min_delay, max_delay):
+
+    # Returns the seconds to wait before polling search again: the previous
+    # delay doubled (exponential backoff), shortened to the estimated
+    # remaining time when QRadar reports the search progress.
+    delay = min(max(delay * 2, min_delay), max_delay)
+
+    progress = search.get('progress')
+    elapsed = search.get('query_execution_time')
+    if progress and elapsed and 0 < progress < 100:
+        # query_execution_time is in milliseconds
+        remaining = elapsed / 1000.0 * (100 - progress) / progress
+        delay = max(min_delay, min(delay, remaining))
+
+    return delay
+
+
+def cancel_search(client, search_id):
+
+    # Cancels the search then deletes it with its results, errors are only
+    # logged since this is a cleanup.
+    try:
+        client.update_search(search_id, status='CANCELED')
+    except Exception:
+        logger.warning('Failed to cancel search %s', search_id, exc_info=True)
+    try:
+        client.delete_search(search_id)
+    except Exception:
+        logger.warning('Failed to delete search %s', search_id, exc_info=True)
+
+
+def wait_for_search(client, search_id, timeout=None, min_delay=0.2,
+                    max_delay=5):
+
+    # Polls the search with an exponential backoff until it completes and
+    # returns its last status. The search is canceled and TimeoutError raised
+    # if it does not complete within timeout seconds, ValueError is raised if
+    # it ends in error.
+    deadline = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+
+    delay = 0
+    while True:
+        search = read_json(client.get_search(search_id))
+
+        status = search['status']
+        if status == 'COMPLETED':
+            return search
+        if status not in RUNNING_STATUSES:
+            raise ValueError('Search %s ended with status %s' %
+                             (search_id, status))
+
+        delay = next_poll_delay(search, delay, min_delay, max_delay)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning('Search %s still %s after %ss, canceling',
+                               search_id, status, timeout)
+                cancel_search(client, search_id)
+                raise TimeoutError('Search %s timed out' % search_id)
+            delay = min(delay, remaining)
+
+        time.sleep(delay)
+
+
+class SearchManager:
+
+    # Runs Ariel searches for several callers at once, with at most
+    # max_concurrent searches executing in QRadar (which limits the concurrent
+    # searches per user). A single thread creates the queued searches when a
+    # slot is free, polls all the outstanding ones and hands their results
+    # back through futures as they complete.
+    def __init__(self, client, max_concurrent=3, timeout=None, min_delay=0.2,
+                 max_delay=5):
+
+        self.client = client
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+        # (query, future) waiting for a slot
+        self.pending = deque()
+        # search_id -> outstanding search state
+        self.running = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def submit(self, query_expression):
+
+        # Returns a future whose result is the search results as json, or
+        # which raises TimeoutError/ValueError like wait_for_search
+        future = Future()
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError('SearchManager is closed')
+            self.pending.append((query_expression, future))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='ariel-search-manager',
+                                               daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def search(self, query_expression):
+        return self.submit(query_expression).result()
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def start_pending(self):
+        while len(self.running) < self.max_concurrent:
+            with self.condition:
+                if not self.pending:
+                    return
+                query_expression, future = self.pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                search = read_json(self.client.create_search(query_expression))
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            now = time.monotonic()
+            deadline = None
+            if self.timeout is not None:
+                deadline = now + self.timeout
+            self.running[search['search_id']] = {
+                'future': future,
+                'deadline': deadline,
+                'delay': self.min_delay,
+                'next_poll': now + self.min_delay
+            }
+
+    def poll(self, search_id, state):
+        search = read_json(self.client.get_search(search_id))
+        status = search['status']
+
+        if status == 'COMPLETED':
+            del self.running[search_id]
+            state['future'].set_result(read_json(
+                self.client.get_search_results(search_id,
+                                               'application/json')))
+        elif status not in RUNNING_STATUSES:
+            del self.running[search_id]
+            cancel_search(self.client, search_id)
+            state['future'].set_exception(ValueError(
+                'Search %s ended with status %s' % (search_id, status)))
+        elif (state['deadline'] is not None and
+                time.monotonic() >= state['deadline']):
+            del self.running[search_id]
+            logger.warning('Search %s still %s after %ss, canceling',
+                           search_id, status, self.timeout)
+            cancel_search(self.client, search_id)
+            state['future'].set_exception(TimeoutError(
+                'Search %s timed out' % search_id))
+        else:
+            state['delay'] = next_poll_delay(search, state['delay'],
+                                             self.min_delay, self.max_delay)
+            state['next_poll'] = time.monotonic() + state['delay']
+            if state['deadline'] is not None:
+                state['next_poll'] = min(state['next_poll'],
+                                         state['deadline'])
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.pending or self.running or self.stopped):
+                    self.condition.wait()
+                if self.stopped:
+                    break
+
+            self.start_pending()
+
+            now = time.monotonic()
+            for search_id, state in list(self.running.items()):
+                if state['next_poll'] > now:
+                    continue
+                try:
+                    self.poll(search_id, state)
+                except Exception as e:
+                    self.running.pop(search_id, None)
+                    cancel_search(self.client, search_id)
+                    state['future'].set_exception(e)
+
+            with self.condition:
+                if self.running and not (
+                        self.pending and
+                        len(self.running) < self.max_concurrent):
+                    next_poll = min(state['next_poll']
+                                    for state in self.running.values())
+                    self.condition.wait(max(next_poll - time.monotonic(), 0))
+
+        # closing: the outstanding searches are abandoned
+        for search_id, state in list(self.running.items()):
+            cancel_search(self.client, search_id)
+            state['future'].set_exception(RuntimeError('SearchManager closed'))
+        self.running.clear()
+        while self.pending:
+            self.pending.popleft()[1].set_exception(
+                RuntimeError('SearchManager closed'))
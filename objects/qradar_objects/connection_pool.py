@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+# Keep-alive HTTPS transport for the QRadar API clients
+import http.client
+import io
+import queue
+import socket
+import threading
+
+# errors meaning that a kept-alive connection has been closed by the server
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected,
+                           http.client.BadStatusLine,
+                           ConnectionResetError,
+                           BrokenPipeError)
+
+# Requests which can be sent twice without side effect. The other ones
+# (e.g. the POST creating an Ariel search) are only retried on a new
+# connection if they could not be sent on the stale one.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+
+class PooledResponse:
+
+    # Response whose body has already been read, so that its connection can
+    # go back to the pool. It exposes the subset of the urllib response
+    # interface used by the callers (code, msg, read(), info()).
+    def __init__(self, response, body):
+        self.code = response.status
+        self.status = response.status
+        self.msg = response.reason
+        self.reason = response.reason
+        self.headers = response.headers
+        self.length = len(body)
+        self.body = io.BytesIO(body)
+
+    def read(self, amt=None):
+        return self.body.read(amt)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+
+    # HTTPS connection resuming the TLS session of the pool, so that a new
+    # connection to the same server does not pay a full handshake.
+    def __init__(self, pool, host, timeout):
+        super(PooledHTTPSConnection, self).__init__(host, timeout=timeout,
+                                                    context=pool.context)
+        self.pool = pool
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout,
+                                        self.source_address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.sock = self.pool.context.wrap_socket(
+                sock, server_hostname=self.host, session=self.pool.tls_session)
+        except Exception:
+            sock.close()
+            raise
+
+
+class HTTPSConnectionPool:
+
+    # Pool of persistent HTTPS connections to a single server.
+    # At most maxsize idle connections are kept, connections beyond are
+    # closed once their response has been read.
+    def __init__(self, host, context, maxsize=4, connect_timeout=10,
+                 read_timeout=60):
+
+        self.host = host
+        self.context = context
+        self.maxsize = maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.tls_session = None
+        self.idle = queue.LifoQueue(maxsize)
+        self.lock = threading.Lock()
+
+    def get_connection(self, connect_timeout):
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return PooledHTTPSConnection(self, self.host, connect_timeout), False
+
+    def release_connection(self, connection, response):
+        if response.will_close:
+            connection.close()
+            return
+        # keeping the latest session, TLS 1.3 tickets are only received
+        # after the handshake
+        session = connection.sock.session if connection.sock else None
+        if session is not None:
+            with self.lock:
+                self.tls_session = session
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def urlopen(self, method, url, body=None, headers={}, timeout=None):
+
+        connect_timeout = self.connect_timeout
+        read_timeout = self.read_timeout
+        if timeout is not None:
+            connect_timeout = min(connect_timeout, timeout)
+            read_timeout = min(read_timeout, timeout)
+
+        connection, reused = self.get_connection(connect_timeout)
+        sent = False
+        try:
+            if connection.sock is None:
+                connection.connect()
+            connection.sock.settimeout(read_timeout)
+            connection.request(method, url, body=body, headers=headers)
+            sent = True
+            response = connection.getresponse()
+        except STALE_CONNECTION_ERRORS:
+            connection.close()
+            if not reused or (sent and method.upper() not in IDEMPOTENT_METHODS):
+                # the server may have processed the request
+                raise
+            # the server closed the idle connection, retrying once on a
+            # new one
+            connection = PooledHTTPSConnection(self, self.host,
+                                               connect_timeout)
+            try:
+                connection.connect()
+                connection.sock.settimeout(read_timeout)
+                connection.request(method, url, body=body, headers=headers)
+                response = connection.getresponse()
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+
+        try:
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        self.release_connection(connection, response)
+        return PooledResponse(response, data)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
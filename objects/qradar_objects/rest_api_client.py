@@ -2,25 +2,32 @@
 # -*- coding: utf8 -*-
 
 # QRadar API requirements
-from urllib.error import HTTPError
-from urllib.error import URLError
 from urllib.parse import quote
-from urllib.request import Request
-from urllib.request import urlopen
 from urllib.request import install_opener
 from urllib.request import build_opener
 from urllib.request import HTTPSHandler
 import ssl
 import sys
+import time
+import socket
 import base64
 
+from .connection_pool import HTTPSConnectionPool
+
 # QRadar API from https://github.com/ibm-security-intelligence/api-samples
 # This is a simple HTTP client that can be used to access the REST API
 class RestApiClient:
 
     # Constructor for the RestApiClient Class
-    def __init__(self, server_ip, auth_token, certificate_file, version):
+    # Requests go through a pool of at most pool_size kept-alive connections,
+    # connect_timeout and read_timeout being in seconds. observer, if given,
+    # is called after each request with (method, path, status, seconds,
+    # request_bytes, response_bytes, error).
+    def __init__(self, server_ip, auth_token, certificate_file, version,
+                 pool_size=4, connect_timeout=10, read_timeout=60,
+                 observer=None):
 
+        self.observer = observer
 
         self.headers = {'Accept': 'application/json'}
         self.headers['SEC'] = auth_token
@@ -32,6 +39,9 @@ class RestApiClient:
         self.context.check_hostname = False
         self.context.verify_mode = ssl.CERT_NONE
 
+        self.pool = HTTPSConnectionPool(server_ip, self.context, pool_size,
+                                        connect_timeout, read_timeout)
+
         # # Create a secure SSLContext
         # # PROTOCOL_SSLv23 is misleading.  PROTOCOL_SSLv23 will use the highest
         # # version of SSL or TLS that both the client and server supports.
@@ -70,8 +80,9 @@ class RestApiClient:
         # install_opener(build_opener(HTTPSHandler(context=context, check_hostname=check_hostname)))
 
     # This method is used to set up an HTTP request and send it to the server
+    # timeout (in seconds) applies to the connection and to each read on it
     def call_api(self, endpoint, method, headers=None, params=[], data=None,
-                 print_request=False):
+                 print_request=False, timeout=None):
 
         path = self.parse_path(endpoint, params)
 
@@ -82,38 +93,53 @@ class RestApiClient:
             for header_key in headers:
                 actual_headers[header_key] = headers[header_key]
 
-        # Send the request and receive the response
-        request = Request('https://' + self.server_ip + self.base_uri + path, headers=actual_headers)
-        request.get_method = lambda: method
+        # Header names may be given as bytes (see APIClient), they override
+        # the default headers of the same name.
+        actual_headers = dict(
+            (k.decode('utf-8') if isinstance(k, bytes) else k, v)
+            for k, v in actual_headers.items())
+        if data is not None and 'Content-Type' not in actual_headers:
+            actual_headers['Content-Type'] = 'application/x-www-form-urlencoded'
 
         # Print the request if print_request is True.
         # if print_request:
         #     SampleUtilities.pretty_print_request(self, path, method,
         #                                          headers=actual_headers)
 
+        # Send the request and receive the response, whatever its status
+        start = time.monotonic()
         try:
-            response = urlopen(request, data, context=self.context)
-
-            response_info = response.info()
-            if 'Deprecated' in response_info:
-
-                # This version of the API is Deprecated. Print a warning to
-                # stderr.
-                print("WARNING: " + response_info['Deprecated'],
-                      file=sys.stderr)
-
-            # returns response object for opening url.
-            return response
-        except HTTPError as e:
-            # an object which contains information similar to a request object
-            return e
-        except URLError as e:
-            if (isinstance(e.reason, ssl.SSLError) and
-                    e.reason.reason == "CERTIFICATE_VERIFY_FAILED"):
+            response = self.pool.urlopen(method, self.base_uri + path,
+                                         body=data, headers=actual_headers,
+                                         timeout=timeout)
+        except OSError as e:
+            if self.observer is not None:
+                error = 'timeout' if isinstance(e, socket.timeout) else 'connection'
+                self.observer(method, path, None, time.monotonic() - start,
+                              len(data) if data else 0, None, error)
+            if isinstance(e, ssl.SSLError) and e.reason == "CERTIFICATE_VERIFY_FAILED":
                 print("Certificate verification failed.")
                 sys.exit(3)
-            else:
-                raise e
+            raise
+
+        if self.observer is not None:
+            self.observer(method, path, response.code, time.monotonic() - start,
+                          len(data) if data else 0, response.length)
+
+        response_info = response.info()
+        if 'Deprecated' in response_info:
+
+            # This version of the API is Deprecated. Print a warning to
+            # stderr.
+            print("WARNING: " + response_info['Deprecated'],
+                  file=sys.stderr)
+
+        # returns response object for opening url.
+        return response
+
+    # Closes the kept-alive connections
+    def close(self):
+        self.pool.close()
 
     # This method constructs the query string
     def parse_path(self, endpoint, params):
@@ -3,6 +3,7 @@
 
 import json
 import sys
+import time
 
 import magic
 import os
@@ -10,9 +11,11 @@ import warnings
 import json
 import magic
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase
+from requests.packages.urllib3.util.retry import Retry
 
-from .models import CaseHelper
+from .models import CaseHelper, dumps_compact
 from .query import *
 from .exceptions import *
 
@@ -31,6 +34,63 @@ class BearerAuth(AuthBase):
         return req
 
 
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+        A transport adapter applying a default timeout to the requests
+        sent without one
+
+        :param timeout: The default timeout, in seconds or as a (connect, read) tuple
+        :param observer: Called after each request with (method, path, status, seconds,
+                         request_bytes, response_bytes, error)
+    """
+    def __init__(self, timeout=None, observer=None, **kwargs):
+        self.timeout = timeout
+        self.observer = observer
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if self.observer is None:
+            return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+        path = request.path_url
+        request_bytes = len(request.body) if request.body else 0
+        start = time.monotonic()
+        try:
+            response = super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+        except requests.exceptions.Timeout:
+            self.observer(request.method, path, None, time.monotonic() - start,
+                          request_bytes, None, 'timeout')
+            raise
+        except requests.exceptions.RequestException:
+            self.observer(request.method, path, None, time.monotonic() - start,
+                          request_bytes, None, 'connection')
+            raise
+
+        # the body is not read yet, its size is taken from the headers
+        response_bytes = response.headers.get('Content-Length')
+        self.observer(request.method, path, response.status_code, time.monotonic() - start,
+                      request_bytes, int(response_bytes) if response_bytes else None)
+        return response
+
+
+# Only idempotent requests are retried on 502/503/504 responses,
+# connection failures are retried for every method
+RETRY_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS'])
+
+
+def build_retry(retries):
+    options = dict(total=retries, connect=retries, read=0, status=retries,
+                   backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                   raise_on_status=False)
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **options)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=RETRY_METHODS, **options)
+
+
 class TheHiveApi:
 
     """
@@ -39,9 +99,14 @@ class TheHiveApi:
         :param url: thehive URL
         :param principal: The username or the API key
         :param password: The password for basic authentication or None. Defaults to None
+        :param pool_maxsize: The number of connections kept alive to TheHive. Defaults to 10
+        :param timeout: The default timeout, in seconds or as a (connect, read) tuple. Defaults to (10, 60)
+        :param retries: The number of retries on connection failures. Defaults to 3
+        :param observer: Called after each request, see TimeoutHTTPAdapter. Defaults to None
     """
 
-    def __init__(self, url, principal, password=None, proxies={}, cert=True):
+    def __init__(self, url, principal, password=None, proxies={}, cert=True,
+                 pool_maxsize=10, timeout=(10, 60), retries=3, observer=None):
 
         self.url = url
         self.principal = principal
@@ -55,9 +120,27 @@ class TheHiveApi:
 
         self.cert = cert
 
+        # Every request goes through this session, which keeps the
+        # connections alive and can be shared by several threads
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.proxies.update(self.proxies)
+        self.session.verify = self.cert
+        adapter = TimeoutHTTPAdapter(timeout=timeout, observer=observer, pool_connections=1,
+                                     pool_maxsize=pool_maxsize,
+                                     max_retries=build_retry(retries))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
         # Create a CaseHelper instance
         self.case = CaseHelper(self)
 
+    def close(self):
+        """
+            Closes the connections kept alive to TheHive
+        """
+        self.session.close()
+
     def __find_rows(self, find_url, **attributes):
         """
             :param find_url: URL of the find api
@@ -79,13 +162,12 @@ class TheHiveApi:
         }
 
         try:
-            return requests.post(req, params=params, json=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.post(req, params=params, json=data)
         except requests.exceptions.RequestException as e:
             raise TheHiveException("Error: {}".format(e))
 
     def do_patch(self, api_url, **attributes):
-        return requests.patch(self.url + api_url, headers={'Content-Type': 'application/json'}, json=attributes,
-                              proxies=self.proxies, auth=self.auth, verify=self.cert)
+        return self.session.patch(self.url + api_url, headers={'Content-Type': 'application/json'}, json=attributes)
 
     def create_case(self, case):
 
@@ -97,9 +179,9 @@ class TheHiveApi:
         """
 
         req = self.url + "/api/case"
-        data = case.jsonify()
+        data = case.jsonify(compact=True)
         try:
-            return requests.post(req, headers={'Content-Type': 'application/json'}, data=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.post(req, headers={'Content-Type': 'application/json'}, data=data)
         except requests.exceptions.RequestException as e:
             raise CaseException("Case create error: {}".format(e))
 
@@ -117,9 +199,9 @@ class TheHiveApi:
             'title', 'description', 'severity', 'startDate', 'owner', 'flag', 'tlp', 'tags', 'status', 'resolutionStatus',
             'impactStatus', 'summary', 'endDate', 'metrics', 'customFields'
         ]
-        data = {k: v for k, v in case.__dict__.items() if (len(fields) > 0 and k in fields) or (len(fields) == 0 and k in update_keys)}
+        data = {k: v for k, v in case.to_dict().items() if (len(fields) > 0 and k in fields) or (len(fields) == 0 and k in update_keys)}
         try:
-            return requests.patch(req, headers={'Content-Type': 'application/json'}, json=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.patch(req, headers={'Content-Type': 'application/json'}, data=dumps_compact(data))
         except requests.exceptions.RequestException:
             raise CaseException("Case update error: {}".format(e))
 
@@ -135,10 +217,10 @@ class TheHiveApi:
         """
 
         req = self.url + "/api/case/{}/task".format(case_id)
-        data = case_task.jsonify()
+        data = case_task.jsonify(compact=True)
 
         try:
-            return requests.post(req, headers={'Content-Type': 'application/json'}, data=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.post(req, headers={'Content-Type': 'application/json'}, data=data)
         except requests.exceptions.RequestException as e:
             raise CaseTaskException("Case task create error: {}".format(e))
 
@@ -155,11 +237,10 @@ class TheHiveApi:
             'title', 'description', 'status', 'order', 'user', 'owner', 'flag', 'endDate'
         ]
 
-        data = {k: v for k, v in task.__dict__.items() if k in update_keys}
+        data = {k: v for k, v in task.to_dict().items() if k in update_keys}
 
         try:
-            return requests.patch(req, headers={'Content-Type': 'application/json'}, json=data,
-                                  proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.patch(req, headers={'Content-Type': 'application/json'}, data=dumps_compact(data))
         except requests.exceptions.RequestException as e:
             raise CaseTaskException("Case task update error: {}".format(e))
 
@@ -179,12 +260,12 @@ class TheHiveApi:
         if case_task_log.file:
             f = {'attachment': (os.path.basename(case_task_log.file), open(case_task_log.file, 'rb'), magic.Magic(mime=True).from_file(case_task_log.file))}
             try:
-                return requests.post(req, data=data,files=f, proxies=self.proxies, auth=self.auth, verify=self.cert)
+                return self.session.post(req, data=data,files=f)
             except requests.exceptions.RequestException as e:
                 raise CaseTaskException("Case task log create error: {}".format(e))
         else:
             try:
-                return requests.post(req, headers={'Content-Type': 'application/json'}, data=json.dumps({'message':case_task_log.message}), proxies=self.proxies, auth=self.auth, verify=self.cert)
+                return self.session.post(req, headers={'Content-Type': 'application/json'}, data=json.dumps({'message':case_task_log.message}))
             except requests.exceptions.RequestException as e:
                 raise CaseTaskException("Case task log create error: {}".format(e))
 
@@ -209,12 +290,12 @@ class TheHiveApi:
                     "ioc": case_observable.ioc
                     })
                 data = {"_json": mesg}
-                return requests.post(req, data=data, files=case_observable.data[0], proxies=self.proxies, auth=self.auth, verify=self.cert)
+                return self.session.post(req, data=data, files=case_observable.data[0])
             except requests.exceptions.RequestException as e:
                 raise CaseObservableException("Case observable create error: {}".format(e))
         else:
             try:
-                return requests.post(req, headers={'Content-Type': 'application/json'}, data=case_observable.jsonify(), proxies=self.proxies, auth=self.auth, verify=self.cert)
+                return self.session.post(req, headers={'Content-Type': 'application/json'}, data=case_observable.jsonify(compact=True))
             except requests.exceptions.RequestException as e:
                 raise CaseObservableException("Case observable create error: {}".format(e))
 
@@ -227,7 +308,7 @@ class TheHiveApi:
         req = self.url + "/api/case/{}".format(case_id)
 
         try:
-            return requests.get(req, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.get(req)
         except requests.exceptions.RequestException as e:
             raise CaseException("Case fetch error: {}".format(e))
 
@@ -271,7 +352,7 @@ class TheHiveApi:
         }
 
         try:
-            return requests.post(req, params=params, json=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.post(req, params=params, json=data)
         except requests.exceptions.RequestException as e:
             raise CaseObservableException("Case observables search error: {}".format(e))
 
@@ -298,7 +379,7 @@ class TheHiveApi:
         }
 
         try:
-            return requests.post(req, params=params, json=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.post(req, params=params, json=data)
         except requests.exceptions.RequestException as e:
             raise CaseTaskException("Case tasks search error: {}".format(e))
 
@@ -311,7 +392,7 @@ class TheHiveApi:
         req = self.url + "/api/case/{}/links".format(case_id)
 
         try:
-            return requests.get(req, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.get(req)
         except requests.exceptions.RequestException as e:
             raise CaseException("Linked cases fetch error: {}".format(e))
 
@@ -337,7 +418,7 @@ class TheHiveApi:
         }
 
         try:
-            response = requests.post(req, json=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            response = self.session.post(req, json=data)
             json_response = response.json()
 
             if response.status_code == 200 and len(json_response) > 0:
@@ -358,7 +439,7 @@ class TheHiveApi:
 
         req = self.url + "/api/case/task/{}/log".format(taskId)
         try:
-            return requests.get(req, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.get(req)
         except requests.exceptions.RequestException as e:
             raise CaseTaskException("Case task logs search error: {}".format(e))
 
@@ -372,9 +453,9 @@ class TheHiveApi:
         """
 
         req = self.url + "/api/alert"
-        data = alert.jsonify()
+        data = alert.jsonify(compact=True)
         try:
-            return requests.post(req, headers={'Content-Type': 'application/json'}, data=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.post(req, headers={'Content-Type': 'application/json'}, data=data)
         except requests.exceptions.RequestException as e:
             raise AlertException("Alert create error: {}".format(e))
 
@@ -387,7 +468,7 @@ class TheHiveApi:
         req = self.url + "/api/alert/{}/markAsRead".format(alert_id)
 
         try:
-            return requests.post(req, headers={'Content-Type': 'application/json'}, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.post(req, headers={'Content-Type': 'application/json'})
         except requests.exceptions.RequestException:
             raise AlertException("Mark alert as read error: {}".format(e))
 
@@ -400,7 +481,7 @@ class TheHiveApi:
         req = self.url + "/api/alert/{}/markAsUnread".format(alert_id)
 
         try:
-            return requests.post(req, headers={'Content-Type': 'application/json'}, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.post(req, headers={'Content-Type': 'application/json'})
         except requests.exceptions.RequestException:
             raise AlertException("Mark alert as unread error: {}".format(e))
 
@@ -417,13 +498,14 @@ class TheHiveApi:
         # update only the alert attributes that are not read-only
         update_keys = ['tlp', 'severity', 'tags', 'caseTemplate', 'title', 'description']
 
-        data = {k: v for k, v in alert.__dict__.items() if
-                (len(fields) > 0 and k in fields) or (len(fields) == 0 and k in update_keys)}
+        # only the requested attributes are read, the artifacts are serialized when asked for
+        data = {k: getattr(alert, k) for k in (fields if len(fields) > 0 else update_keys)
+                if k != 'artifacts' and hasattr(alert, k)}
 
-        if hasattr(alert, 'artifacts'):
-            data['artifacts'] = [a.__dict__ for a in alert.artifacts]
+        if len(fields) == 0 or 'artifacts' in fields:
+            data['artifacts'] = [a.to_dict() for a in alert.artifacts]
         try:
-            return requests.patch(req, headers={'Content-Type': 'application/json'}, json=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.patch(req, headers={'Content-Type': 'application/json'}, data=dumps_compact(data))
         except requests.exceptions.RequestException:
             raise AlertException("Alert update error: {}".format(e))
 
@@ -436,7 +518,7 @@ class TheHiveApi:
         req = self.url + "/api/alert/{}".format(alert_id)
 
         try:
-            return requests.get(req, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.get(req)
         except requests.exceptions.RequestException as e:
             raise AlertException("Alert fetch error: {}".format(e))
 
@@ -460,9 +542,7 @@ class TheHiveApi:
         req = self.url + "/api/alert/{}/createCase".format(alert_id)
 
         try:
-            return requests.post(req, headers={'Content-Type': 'application/json'},
-                                 proxies=self.proxies, auth=self.auth,
-                                 verify=self.cert, data=json.dumps({}))
+            return self.session.post(req, headers={'Content-Type': 'application/json'}, data=json.dumps({}))
 
         except requests.exceptions.RequestException as the_exception:
             raise AlertException("Couldn't promote alert to case: {}".format(the_exception))
@@ -485,7 +565,7 @@ class TheHiveApi:
                 "artifactId": artifact_id,
                 "analyzerId": analyzer_id
                 })
-            return requests.post(req, headers={'Content-Type': 'application/json'}, data=data, proxies=self.proxies, auth=self.auth, verify=self.cert)
+            return self.session.post(req, headers={'Content-Type': 'application/json'}, data=data)
         except requests.exceptions.RequestException as e:
             raise TheHiveException("Analyzer run error: {}".format(e))
 
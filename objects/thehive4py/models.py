@@ -12,19 +12,63 @@ from future.utils import raise_with_traceback
 
 from .exceptions import TheHiveException, CaseException
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class CustomJsonEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, JSONSerializable):
-            return o.__dict__
+            return o.to_dict()
         else:
             return json.JSONEncoder.default(self, o)
 
 
+def dumps_compact(data):
+    """
+    Serialize data without indentation nor key sorting, with orjson when installed.
+    :param data: The dict or list to serialize.
+
+    :return: The JSON document, as bytes with orjson and as str otherwise.
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'))
+
+
 class JSONSerializable(object):
-    def jsonify(self):
+    # the subclasses declaring __slots__ have no per-instance __dict__
+    __slots__ = ()
+
+    def jsonify(self, compact=False):
+        """
+        Serialize the object.
+        :param compact: Build the payload with to_dict and serialize it without
+                        indentation nor key sorting, for the requests sent to TheHive.
+        """
+        if compact:
+            return dumps_compact(self.to_dict())
         return json.dumps(self, sort_keys=True, indent=4, cls=CustomJsonEncoder)
 
+    def to_dict(self):
+        """Return the attributes of the object as a dict, nested objects included."""
+        if hasattr(self, '__dict__'):
+            items = self.__dict__.items()
+        else:
+            # unset slots are left out
+            items = ((k, getattr(self, k)) for k in self.__slots__ if hasattr(self, k))
+
+        data = {}
+        for k, v in items:
+            if isinstance(v, JSONSerializable):
+                v = v.to_dict()
+            elif isinstance(v, list):
+                v = [i.to_dict() if isinstance(i, JSONSerializable) else i for i in v]
+            data[k] = v
+        return data
+
     def attr(self, attributes, name, default, error=None):
         is_required = error is not None
 
@@ -64,7 +108,14 @@ class CustomFieldHelper(object):
         return self.fields
 
 
+# Case attributes set by CaseHelper or before calling update_case, sent only when set
+CASE_OPTIONAL_FIELDS = ('id', 'owner', 'caseId', 'status', 'createdAt', 'createdBy', 'updatedAt',
+                        'updatedBy', 'resolutionStatus', 'impactStatus', 'summary', 'endDate')
+
+
 class Case(JSONSerializable):
+    __slots__ = ('title', 'description', 'tlp', 'severity', 'flag', 'tags', 'startDate', 'metrics',
+                 'customFields', 'template', 'tasks') + CASE_OPTIONAL_FIELDS
 
     def __init__(self, **attributes):
         defaults = {
@@ -107,6 +158,25 @@ class Case(JSONSerializable):
             else:
                 self.tasks.append(CaseTask(json=task))
 
+    def to_dict(self):
+        data = {
+            'title': self.title,
+            'description': self.description,
+            'tlp': self.tlp,
+            'severity': self.severity,
+            'flag': self.flag,
+            'tags': self.tags,
+            'startDate': self.startDate,
+            'metrics': self.metrics,
+            'customFields': self.customFields,
+            'template': self.template,
+            'tasks': [t.to_dict() for t in self.tasks]
+        }
+        for k in CASE_OPTIONAL_FIELDS:
+            if hasattr(self, k):
+                data[k] = getattr(self, k)
+        return data
+
 
 class CaseHelper:
     """
@@ -200,6 +270,9 @@ class CaseHelper:
 
 
 class CaseTask(JSONSerializable):
+    __slots__ = ('title', 'status', 'flag', 'description', 'owner', 'startDate', 'group',
+                 # set before calling update_case_task, sent only when set
+                 'id', 'order', 'user', 'endDate')
 
     def __init__(self, **attributes):
         if attributes.get('json', False):
@@ -266,6 +339,9 @@ class CaseObservable(JSONSerializable):
 
 
 class Alert(JSONSerializable):
+    __slots__ = ('tlp', 'severity', 'date', 'tags', 'caseTemplate', 'title', 'type', 'source',
+                 'sourceRef', 'description', 'customFields', 'artifacts')
+
     def __init__(self, **attributes):
         if attributes.get('json', False):
             attributes = attributes['json']
@@ -291,8 +367,26 @@ class Alert(JSONSerializable):
             else:
                 self.artifacts.append(AlertArtifact(json=artifact))
 
+    def to_dict(self):
+        return {
+            'tlp': self.tlp,
+            'severity': self.severity,
+            'date': self.date,
+            'tags': self.tags,
+            'caseTemplate': self.caseTemplate,
+            'title': self.title,
+            'type': self.type,
+            'source': self.source,
+            'sourceRef': self.sourceRef,
+            'description': self.description,
+            'customFields': self.customFields,
+            'artifacts': [a.to_dict() for a in self.artifacts]
+        }
+
 
 class AlertArtifact(JSONSerializable):
+    __slots__ = ('dataType', 'message', 'tlp', 'tags', 'data')
+
     def __init__(self, **attributes):
         if attributes.get('json', False):
             attributes = attributes['json']
@@ -307,6 +401,15 @@ class AlertArtifact(JSONSerializable):
         else:
             self.data = attributes.get('data', None)
 
+    def to_dict(self):
+        return {
+            'dataType': self.dataType,
+            'message': self.message,
+            'tlp': self.tlp,
+            'tags': self.tags,
+            'data': self.data
+        }
+
     def _prepare_file_data(self, file_path):
         with open(file_path, "rb") as file_artifact:
             filename = os.path.basename(file_path)
@@ -7,6 +7,9 @@ import json
 from .thehive4py.api import TheHiveApi
 from .thehive4py.models import Case, CaseTask, CaseTaskLog, CaseObservable, AlertArtifact, Alert
 from .thehive4py.query import Eq
+from .alert_index import AlertIndex, alertContentHash
+from .common import resolvePath
+from .metrics import apiObserver, timed
 
 class TheHiveConnector:
     'TheHive connector'
@@ -17,13 +20,34 @@ class TheHiveConnector:
 
         self.theHiveApi = self.connect()
 
+        #local index of the imported alerts, disabled if no path is set
+        self.alertIndex = None
+        #pending log attachments, kept in memory when the index is disabled
+        self.pendingLogs = dict()
+        alertIndexPath = resolvePath(self.cfg.get('TheHive', 'alert_index', fallback=''))
+        if alertIndexPath:
+            self.alertIndex = AlertIndex(alertIndexPath)
+
     def connect(self):
         self.logger.info('%s.connect starts', __name__)
 
         url = self.cfg.get('TheHive', 'url')
         api_key = self.cfg.get('TheHive', 'api_key')
 
-        return TheHiveApi(url, api_key, cert=False)
+        pool_size = self.cfg.getint('TheHive', 'pool_size', fallback=10)
+        timeout = (self.cfg.getfloat('TheHive', 'connect_timeout', fallback=10),
+            self.cfg.getfloat('TheHive', 'read_timeout', fallback=60))
+        retries = self.cfg.getint('TheHive', 'retries', fallback=3)
+
+        return TheHiveApi(url, api_key, cert=False, pool_maxsize=pool_size,
+            timeout=timeout, retries=retries, observer=apiObserver('thehive'))
+
+    def close(self):
+        self.logger.info('%s.close starts', __name__)
+
+        self.theHiveApi.close()
+        if self.alertIndex is not None:
+            self.alertIndex.close()
 
     def searchCaseByDescription(self, string):
         #search case with a specific string in description
@@ -188,17 +212,63 @@ class TheHiveConnector:
 
         return alert
 
+    @timed('alert_creation')
     def createAlert(self, alert):
         self.logger.info('%s.createAlert starts', __name__)
 
         response = self.theHiveApi.create_alert(alert)
 
         if response.status_code == 201:
-            return response.json()
+            createdAlert = response.json()
+            if self.alertIndex is not None:
+                self.indexAlert(alert, createdAlert)
+            return createdAlert
         else:
             self.logger.error('Alert creation failed')
             raise ValueError(json.dumps(response.json(), indent=4, sort_keys=True))
 
+    def indexAlert(self, alert, createdAlert):
+        """
+            Records the alert just created in the alert index; the alert
+            existing in TheHive, a failure is only logged and the index
+            marked as not reconciled, so that the offense is searched in
+            TheHive rather than imported again
+        """
+        try:
+            self.alertIndex.add(alert.sourceRef, createdAlert['id'],
+                createdAlert.get('createdAt'), alertContentHash(alert))
+        except Exception as e:
+            self.logger.error('Failed to index alert %s of %s', createdAlert['id'],
+                alert.sourceRef, exc_info=True)
+            try:
+                self.alertIndex.unreconcile()
+            except Exception as e:
+                self.logger.error('Failed to mark the alert index as not reconciled, '
+                    'run smart_cloner.py --reindex', exc_info=True)
+
+    @timed('alert_update')
+    def updateAlert(self, alertId, alert, fields):
+        """
+            Updates some fields of an alert in TheHive
+
+            :param alertId: TheHive alert id
+            :type alertId: str
+            :param alert: alert holding the new field values
+            :type alert: Alert
+            :param fields: names of the fields to update
+            :type fields: list
+        """
+
+        self.logger.info('%s.updateAlert starts', __name__)
+
+        response = self.theHiveApi.update_alert(alertId, alert, fields=fields)
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            self.logger.error('Alert update failed')
+            raise ValueError(json.dumps(response.json(), indent=4, sort_keys=True))
+
     def findAlert(self, q):
         """
             Search for alerts in TheHive for a given query
@@ -220,6 +290,121 @@ class TheHiveConnector:
             self.logger.error('findAlert failed')
             raise ValueError(json.dumps(response.json(), indent=4, sort_keys=True))
 
+    @timed('dedup_search')
+    def alertExists(self, sourceRef):
+        """
+            Checks if an alert already exists for sourceRef, looking in
+            the local alert index first and searching TheHive only if the
+            index is disabled or has never been reconciled
+
+            :param sourceRef: alert sourceRef
+            :type sourceRef: str
+
+            :return: True if the alert exists
+            :rtype: bool
+        """
+
+        self.logger.info('%s.alertExists starts', __name__)
+
+        if self.alertIndex is not None:
+            if self.alertIndex.get(sourceRef) is not None:
+                return True
+            if self.alertIndex.isReconciled():
+                return False
+
+        results = self.findAlert({'sourceRef': sourceRef})
+        if len(results) == 0:
+            return False
+
+        if self.alertIndex is not None:
+            self.alertIndex.add(sourceRef, results[0]['id'],
+                results[0].get('createdAt'), alertContentHash(results[0]))
+        return True
+
+    def setPendingLogs(self, alertId, offense, attempt, dueAt):
+        """
+            Records that the logs of offense are still to be added to the
+            description of alert alertId, from dueAt (seconds since epoch);
+            the record survives restarts only if the alert index is enabled
+
+            :param alertId: TheHive alert id
+            :type alertId: str
+            :param offense: the enriched offense, without logs
+            :type offense: dict
+            :param attempt: number of times the logs have been searched
+            :type attempt: int
+            :param dueAt: time of the next search
+            :type dueAt: float
+        """
+        if self.alertIndex is not None:
+            self.alertIndex.setPendingLogs(alertId, offense, attempt, dueAt)
+        else:
+            self.pendingLogs[alertId] = (alertId, offense, attempt, dueAt)
+
+    def removePendingLogs(self, alertId):
+        if self.alertIndex is not None:
+            self.alertIndex.removePendingLogs(alertId)
+        else:
+            self.pendingLogs.pop(alertId, None)
+
+    def getPendingLogs(self):
+        """
+            Returns the pending log attachments as
+            (alert id, offense, attempt, due at) tuples
+        """
+        if self.alertIndex is not None:
+            return self.alertIndex.getPendingLogs()
+        return sorted(self.pendingLogs.values(), key=lambda pending: pending[3])
+
+    def findAlertsPages(self, q, pageSize):
+        """
+            Search for alerts in TheHive for a given query, page by page
+
+            :param q: TheHive query
+            :type q: dict
+            :param pageSize: number of alerts per page
+            :type pageSize: int
+
+            :return: pages of alerts, each page being a list of dict
+            :rtype: generator
+        """
+
+        self.logger.info('%s.findAlertsPages starts', __name__)
+
+        start = 0
+        while True:
+            response = self.theHiveApi.find_alerts(query=q,
+                range='%d-%d' % (start, start + pageSize), sort=['+createdAt'])
+            if response.status_code != 200:
+                self.logger.error('findAlertsPages failed')
+                raise ValueError(json.dumps(response.json(), indent=4, sort_keys=True))
+
+            page = response.json()
+            if page:
+                yield page
+            if len(page) < pageSize:
+                return
+            start += pageSize
+
+    def reconcileAlertIndex(self, q):
+        """
+            Rebuilds the local alert index from the alerts found in TheHive
+
+            :param q: TheHive query matching the alerts to index
+            :type q: dict
+
+            :return: number of indexed alerts
+            :rtype: int
+        """
+
+        self.logger.info('%s.reconcileAlertIndex starts', __name__)
+
+        if self.alertIndex is None:
+            raise ValueError('alert_index is not set in the TheHive configuration')
+
+        pageSize = self.cfg.getint('TheHive', 'alert_index_page_size', fallback=500)
+        return self.alertIndex.rebuild(self.findAlertsPages(q, pageSize))
+
     def findFirstMatchingTemplate(self, searchstring):
         self.logger.info('%s.findFirstMatchingTemplate starts', __name__)
 
@@ -1,43 +1,135 @@
 import os
+import random
+import signal
+import argparse
+import threading
 import logging
 import logging.config
-from objects.common import getConf, setConf
-from objects.offense2alert import allOffense2Alert
+from objects.common import getConf, resolvePath
+from objects.lock import InstanceLock
+from objects import metrics
+from objects import profiling
+from objects.qradar_connector import QRadarConnector
+from objects.thehive_connector import TheHiveConnector
+from objects.offense2alert import allOffense2Alert, reindexAlerts
 
-def qradar2thehive():
+def setupLogging():
     ## logger configuration
     currentPath = os.path.dirname(os.path.abspath(__file__))
     loggerConfPath = currentPath + '/conf/log.conf'
     logging.config.fileConfig(loggerConfPath)
 
+def logReport(logger, report):
+    for reportOffense in report['offenses']:
+        logger.info("Is offense " + str(reportOffense['qradar_offense_id']) +
+                    " clonned to alert " + str(reportOffense['raised_alert_id']) +
+                    " : " + str(reportOffense['success']))
+
+def instanceLock(cfg):
+    return InstanceLock(
+        resolvePath(cfg.get('smartclonner', 'lock_file', fallback='cache/smartclonner.lock')),
+        cfg.getfloat('smartclonner', 'lock_heartbeat_interval', fallback=30),
+        cfg.getfloat('smartclonner', 'lock_stale_after', fallback=300))
+
+def qradar2thehive(profile=None):
+    setupLogging()
+
     logger = logging.getLogger(__name__)
 
     logger.info('%s.SMART_CLONNER', __name__)
 
     cfg = getConf()
 
-    scStatus = cfg['smartclonner']['status']
-    logger.info("smartclonner status: " + scStatus)
+    lock = instanceLock(cfg)
+    if not lock.acquire():
+        logger.info("another instance of smartclonner has been launched")
+        return
 
-    if int(scStatus) == 0:
-        try:
-            cfg['smartclonner']['status'] = str(1)
-            setConf(cfg)
-            logger.info("launching clonning offenses as alert")
+    try:
+        metrics.setup(cfg)
+        profiling.setup(cfg, profile)
+        logger.info("launching clonning offenses as alert")
+        with profiling.profiled('run', 'run'):
             report = allOffense2Alert()
-            for reportOffense in report['offenses']:
-                logger.info("Is offense " + str(reportOffense['qradar_offense_id']) +
-                            " clonned to alert " + str(reportOffense['raised_alert_id']) +
-                            " : " + str(reportOffense['success']))
-        except Exception as ex:
-            logger.error("Tool exception: " + str(ex))
-
-        # set status to "completed"
-        cfg = getConf()
-        cfg['smartclonner']['status'] = str(0)
-        setConf(cfg)
-    else:
+        logReport(logger, report)
+    except Exception as ex:
+        logger.error("Tool exception: " + str(ex))
+    finally:
+        metrics.export(getConf())
+        metrics.registry.close()
+        lock.release()
+
+def qradar2thehiveDaemon(profile=None):
+    """
+        Resident mode: keeps the QRadar and TheHive connectors alive and
+        polls QRadar for new offenses every poll_interval seconds (plus
+        a random jitter of up to poll_jitter seconds) until SIGTERM/SIGINT
+    """
+    setupLogging()
+
+    logger = logging.getLogger(__name__)
+
+    logger.info('%s.SMART_CLONNER_DAEMON', __name__)
+
+    cfg = getConf()
+
+    lock = instanceLock(cfg)
+    if not lock.acquire():
         logger.info("another instance of smartclonner has been launched")
+        return
+
+    pollInterval = cfg.getfloat('smartclonner', 'poll_interval', fallback=30)
+    pollJitter = cfg.getfloat('smartclonner', 'poll_jitter', fallback=5)
+
+    stop = threading.Event()
+
+    def requestStop(signum, frame):
+        logger.info("signal %s received, stopping after the current cycle", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, requestStop)
+    signal.signal(signal.SIGINT, requestStop)
+
+    try:
+        metrics.setup(cfg)
+        profiling.setup(cfg, profile)
+        qradarConnector = QRadarConnector(cfg)
+        theHiveConnector = TheHiveConnector(cfg)
+
+        while not stop.is_set():
+            try:
+                with profiling.profiled('run', 'run'):
+                    report = allOffense2Alert(qradarConnector, theHiveConnector)
+                logReport(logger, report)
+            except Exception as ex:
+                logger.error("Tool exception: " + str(ex))
+            metrics.export(getConf())
+
+            stop.wait(pollInterval + random.uniform(0, pollJitter))
+
+        qradarConnector.close()
+        theHiveConnector.close()
+    except Exception as ex:
+        logger.error("Tool exception: " + str(ex))
+    finally:
+        metrics.registry.close()
+        lock.release()
 
 if __name__ == "__main__":
-    qradar2thehive()
+    parser = argparse.ArgumentParser(description='Clone QRadar offenses as TheHive alerts')
+    parser.add_argument('--daemon', action='store_true',
+        help='keep running and poll QRadar continuously instead of a single run')
+    parser.add_argument('--reindex', action='store_true',
+        help='rebuild the local index of imported alerts from TheHive and exit')
+    parser.add_argument('--profile', nargs='?', const='run', choices=profiling.SCOPES,
+        help='profile each run (default) or each offense, as the %s environment '
+        'variable; profiles are written in [Profiling] directory' % profiling.PROFILE_ENV)
+    args = parser.parse_args()
+
+    if args.reindex:
+        setupLogging()
+        reindexAlerts()
+    elif args.daemon:
+        qradar2thehiveDaemon(args.profile)
+    else:
+        qradar2thehive(args.profile)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from configparser import ConfigParser
+from unittest import mock
+
+from objects import offense2alert
+from objects.checkpoint import CheckpointStore
+
+class AllOffense2AlertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cfg = ConfigParser()
+        self.cfg.read_dict({
+            'smartclonner': {'checkpoint_file': os.path.join(self.directory, 'checkpoint.json')},
+            'QRadar': {'server': 'qradar.local'}})
+
+        self.qradarConnector = mock.MagicMock()
+        self.qradarConnector.aql_batch_size = 1
+        self.qradarConnector.logs_ready_delay = 0.2
+        self.qradarConnector.logs_retries = 2
+        self.qradarConnector.logs_retry_delay = 0.2
+        self.qradarConnector.logs_retry_window = 900
+        self.qradarConnector.rule_names_tags = False
+        self.qradarConnector.getOffenseTypeStr.return_value = 'Source IP'
+        self.qradarConnector.getSourceIPs.return_value = []
+        self.qradarConnector.getLocalDestinationIPs.return_value = []
+        self.qradarConnector.getOffenseLogs.return_value = [{'utf8_payload': 'log'}]
+
+        self.theHiveConnector = mock.MagicMock()
+        self.theHiveConnector.getPendingLogs.return_value = []
+        self.theHiveConnector.createAlert.return_value = {'id': 'alert-42'}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run2alert(self, timeout=5):
+        result = dict()
+        def run():
+            with mock.patch.object(offense2alert, 'getConf', return_value=self.cfg):
+                result['report'] = offense2alert.allOffense2Alert(
+                    self.qradarConnector, self.theHiveConnector)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), 'allOffense2Alert did not return')
+        return result['report']
+
+    def testDeferredOffenseNotLookedUpAgain(self):
+        # deferred since its logs are not searchable yet, the offense is left
+        # to the next run; processed again, it is not looked up in TheHive a
+        # second time, which could end the run with its id still deferred
+        offense = {'id': 42, 'start_time': int(time.time() * 1000), 'offense_type': 0,
+            'offense_source': '10.0.0.1', 'description': 'offense', 'severity': 5,
+            'destination_networks': [], 'source_network': 'net'}
+        self.qradarConnector.iterOffensesAfter.side_effect = lambda: iter([dict(offense)])
+        self.theHiveConnector.alertExists.side_effect = [False, True]
+
+        start = time.monotonic()
+        report = self.run2alert()
+        self.assertLess(time.monotonic() - start, self.qradarConnector.logs_ready_delay)
+        self.assertTrue(report['success'])
+        self.assertEqual(report['offenses'], [])
+
+        time.sleep(self.qradarConnector.logs_ready_delay)
+        report = self.run2alert()
+
+        self.assertEqual(self.theHiveConnector.alertExists.call_count, 1)
+        self.assertTrue(report['success'])
+        self.assertEqual([offense_report['raised_alert_id']
+            for offense_report in report['offenses']], ['alert-42'])
+
+    def testCheckpointHeldBelowDeferredOffense(self):
+        now = int(time.time() * 1000)
+        offenses = [{'id': offenseId, 'start_time': startTime, 'offense_type': 0,
+            'offense_source': '10.0.0.1', 'description': 'offense', 'severity': 5,
+            'destination_networks': [], 'source_network': 'net'}
+            for offenseId, startTime in ((42, now), (43, now - 60000))]
+        self.qradarConnector.iterOffensesAfter.side_effect = \
+            lambda: iter([dict(offense) for offense in offenses])
+        self.theHiveConnector.alertExists.return_value = False
+
+        report = self.run2alert()
+
+        self.assertEqual(len(report['offenses']), 1)
+        checkpoint = CheckpointStore(self.cfg.get('smartclonner', 'checkpoint_file'))
+        self.assertEqual(checkpoint.get(), 41)
+        self.assertEqual(list(checkpoint.getDeferred()), [42])
+
+        # the next run polls from the checkpoint
+        self.run2alert()
+        self.assertEqual(self.qradarConnector.offense_id_after, '41')
+
+if __name__ == '__main__':
+    unittest.main()